@@ -1,54 +1,279 @@
 import asyncio
-import requests
+import aiohttp
 import time
 import logging
+from metrics import increment
 
-class RateLimitedWebhook:
-    def __init__(self, webhook_url, update_request_count_callback=None):
-        self.webhook_url = webhook_url
+# Shared HTTP transport settings, can be overridden with configure_session()
+CONNECTION_LIMIT = 100  # Maximum number of simultaneous connections in the pool
+CONNECTION_LIMIT_PER_HOST = 0  # Maximum number of simultaneous connections per host (0 means no limit)
+KEEPALIVE_TIMEOUT = 30  # Seconds to keep idle connections open for reuse
+REQUEST_TIMEOUT = 15  # Total timeout in seconds for a single webhook request
+GLOBAL_RATE_LIMIT = 50  # Discord's global limit in requests per second, shared by every webhook
+MAX_RETRIES = 3  # Retries of a request that failed with a 5xx or a connection error
+RETRY_BASE_DELAY = 1  # Seconds before the first retry, doubled for each one after it
+RETRY_MAX_DELAY = 30
+MAX_RATE_LIMITED_RETRIES = 10  # 429s in a row before giving up on a message
+CIRCUIT_FAILURE_THRESHOLD = 5  # Failed requests in a row before a webhook stops sending for a while
+CIRCUIT_OPEN_TIME = 30  # Seconds the first pause lasts, doubled each time the webhook fails again right after
+CIRCUIT_MAX_OPEN_TIME = 600
+DEAD_WEBHOOK_STATUSES = (401, 404)  # The webhook was deleted or its token is no longer valid
+
+SESSION = None  # Shared aiohttp.ClientSession used by every webhook
+WEBHOOKS = {}  # Webhook URL -> RateLimitedWebhook, so bucket state survives between events
+BUCKETS = {}  # "<X-RateLimit-Bucket>:<webhook id>" -> RateLimitBucket, shared by webhooks on the same bucket
+
+def configure_session(limit=None, limit_per_host=None, keepalive_timeout=None):
+    global CONNECTION_LIMIT, CONNECTION_LIMIT_PER_HOST, KEEPALIVE_TIMEOUT
+    if limit is not None:
+        CONNECTION_LIMIT = limit
+    if limit_per_host is not None:
+        CONNECTION_LIMIT_PER_HOST = limit_per_host
+    if keepalive_timeout is not None:
+        KEEPALIVE_TIMEOUT = keepalive_timeout
+
+def configure_global_rate_limit(rate):
+    # Processes running shards of the same bot each get a share of the global limit
+    GLOBAL_LIMITER.rate = rate
+    GLOBAL_LIMITER.tokens = min(GLOBAL_LIMITER.tokens, float(rate))
+
+def get_session():
+    global SESSION
+    # The session has to be created inside the running event loop, so it is created lazily on first use
+    if SESSION is None or SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        SESSION = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        logging.debug(f"RateLimitedWebhook: Created shared session (limit={CONNECTION_LIMIT}, limit_per_host={CONNECTION_LIMIT_PER_HOST})")
+    return SESSION
+
+def get_webhook(webhook_url, update_request_count_callback=None):
+    webhook = WEBHOOKS.get(webhook_url)
+    if webhook is None:
+        webhook = RateLimitedWebhook(webhook_url, update_request_count_callback=update_request_count_callback)
+        WEBHOOKS[webhook_url] = webhook
+    return webhook
+
+def remove_webhook(webhook_url):
+    # Forget a webhook that was replaced or deleted so its state doesn't linger
+    webhook = WEBHOOKS.pop(webhook_url, None)
+    if webhook is None:
+        return
+    # Its bucket goes too, unless another client for the same webhook still shares it
+    key = webhook.bucket.key
+    if BUCKETS.get(key) is webhook.bucket and not any(other.bucket.key == key for other in WEBHOOKS.values()):
+        del BUCKETS[key]
+
+class WebhookError(Exception):
+    pass
+
+class WebhookDeadError(WebhookError):
+    # The webhook was deleted or its token revoked, nothing will be delivered to it again
+    pass
+
+class WebhookUnavailableError(WebhookError):
+    # The webhook keeps failing, it is paused until the circuit lets a request through again
+    pass
+
+class WebhookRejectedError(WebhookError):
+    # Discord refused the message itself, sending it again would be refused again
+    pass
+
+class GlobalRateLimiter:
+    # Token bucket guarding Discord's global per-bot request limit
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0  # Set when Discord reports a global 429
+
+    async def acquire(self):
+        while True:
+            now = time.time()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+
+            monotonic_now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (monotonic_now - self.last_refill) * self.rate)
+            self.last_refill = monotonic_now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, retry_after):
+        self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+
+GLOBAL_LIMITER = GlobalRateLimiter(GLOBAL_RATE_LIMIT)
+
+class RateLimitBucket:
+    def __init__(self, key):
+        self.key = key
         self.lock = asyncio.Lock()
         self.reset_time = 0.0
         self.remaining_requests = 0
-        self.session = requests.Session()
+
+    def update(self, headers):
+        self.remaining_requests = int(headers.get('X-RateLimit-Remaining', 0))
+        reset_after_header = headers.get('X-RateLimit-Reset-After')
+        reset_time_header = headers.get('X-RateLimit-Reset')
+        if reset_after_header is not None:
+            # Prefer the relative header, it isn't affected by clock skew
+            self.reset_time = time.time() + float(reset_after_header)
+        elif reset_time_header is not None:
+            self.reset_time = float(reset_time_header)
+        else:
+            self.reset_time = 0.0 # Default value if 'X-RateLimit-Reset' is not provided
+
+class RateLimitedWebhook:
+    def __init__(self, webhook_url, update_request_count_callback=None, session=None):
+        self.webhook_url = webhook_url
+        # Webhook URLs look like https://discord.com/api/webhooks/<id>/<token>
+        parts = webhook_url.rstrip('/').split('/')
+        self.webhook_id = parts[-2] if len(parts) >= 2 else webhook_url
+        self.bucket = RateLimitBucket(webhook_url)  # Replaced by the shared bucket once Discord tells us its hash
+        self.session = session  # None means the shared session from get_session() is used
         self.update_request_count_callback = update_request_count_callback
+        # Circuit breaker state
+        self.dead = False
+        self.failures = 0  # Failed requests in a row
+        self.open_until = 0.0  # Monotonic time the circuit lets requests through again
+        self.open_time = CIRCUIT_OPEN_TIME
+
+    def _adopt_bucket(self, headers):
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash is None:
+            return
+        key = f"{bucket_hash}:{self.webhook_id}"
+        if self.bucket.key == key:
+            return
+        bucket = BUCKETS.get(key)
+        if bucket is None:
+            bucket = self.bucket
+            bucket.key = key
+            BUCKETS[key] = bucket
+        self.bucket = bucket
+
+    def _check_circuit(self):
+        if self.dead:
+            raise WebhookDeadError(f"Webhook {self.webhook_id} was deleted or its token is no longer valid")
+        if time.monotonic() < self.open_until:
+            increment('webhook_circuit_rejected_total')
+            raise WebhookUnavailableError(f"Webhook {self.webhook_id} is paused after {self.failures} failed requests")
+
+    def _record_failure(self):
+        self.failures += 1
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            # Past the threshold every failure reopens the circuit, so a half-open webhook that
+            # fails its trial request waits twice as long before the next one
+            self.open_until = time.monotonic() + self.open_time
+            logging.error(f"RateLimitedWebhook: Webhook {self.webhook_id} failed {self.failures} requests in a row, pausing it for {self.open_time} seconds")
+            self.open_time = min(self.open_time * 2, CIRCUIT_MAX_OPEN_TIME)
+            increment('webhook_circuit_opened_total')
+
+    def _record_success(self):
+        self.failures = 0
+        self.open_time = CIRCUIT_OPEN_TIME
+
+    async def send(self, content=None, embed=None, embeds=None):
+        payload = {}
+        if content:
+            payload['content'] = content
+        if embed:
+            payload['embeds'] = [embed.to_dict()]
+        if embeds:
+            payload['embeds'] = [e.to_dict() for e in embeds]
+
+        retries = 0
+        rate_limited = 0
+        while True:
+            bucket = self.bucket
+            async with bucket.lock:
+                if bucket is not self.bucket:
+                    # The webhook moved to a shared bucket while we were waiting, queue on that one instead
+                    continue
+                # Checked after the lock, so sends queued behind a failing one give up without a request
+                self._check_circuit()
+
+                if bucket.remaining_requests == 0 and time.time() < bucket.reset_time:
+                    delay = bucket.reset_time - time.time()
+                    logging.debug(f"RateLimitedWebhook: Waiting for {delay:.2f} seconds due to rate limit")
+                    await asyncio.sleep(delay)
+
+                await GLOBAL_LIMITER.acquire()
+
+                logging.debug(f"RateLimitedWebhook: Sending payload: {payload}")
+                session = self.session or get_session()
+                start_time = time.monotonic()
+                try:
+                    async with session.post(self.webhook_url, json=payload) as response:
+                        # Read the body so the connection is released back to the pool
+                        body = await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    response = None
+                    failure = f"{type(e).__name__}: {str(e)}"
+                latency = time.monotonic() - start_time
+
+                if response is None or response.status >= 500:
+                    # Transient, retried with capped exponential backoff. The bucket lock is held while
+                    # waiting so later messages can't overtake this one
+                    if response is not None:
+                        failure = f"status {response.status}"
+                        if self.update_request_count_callback:
+                            self.update_request_count_callback(latency=latency)
+                    self._record_failure()
+                    increment('webhook_errors_total', reason='server_error' if response is not None else 'connection')
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        raise WebhookUnavailableError(f"Webhook {self.webhook_id} failed {retries} times, last with {failure}")
+                    delay = min(RETRY_BASE_DELAY * 2 ** (retries - 1), RETRY_MAX_DELAY)
+                    logging.warning(f"RateLimitedWebhook: Webhook {self.webhook_id} failed with {failure}, retrying in {delay} seconds")
+                    await asyncio.sleep(delay)
+                    continue
+                logging.debug(f"RateLimitedWebhook: Response status code: {response.status}")
+
+                # Call the update_request_count_callback if it's provided
+                if self.update_request_count_callback:
+                    self.update_request_count_callback(latency=latency)
+
+                self._adopt_bucket(response.headers)
+
+                if response.status in DEAD_WEBHOOK_STATUSES:
+                    # Retrying can't help, stop using the webhook until it is replaced
+                    self.dead = True
+                    increment('webhook_errors_total', reason='dead')
+                    raise WebhookDeadError(f"Webhook {self.webhook_id} returned status {response.status}")
+
+                if response.status == 429:
+                    rate_limited += 1
+                    if rate_limited > MAX_RATE_LIMITED_RETRIES:
+                        raise WebhookError(f"Webhook {self.webhook_id} was still rate limited after {MAX_RATE_LIMITED_RETRIES} retries")
+                    retry_after = response.headers.get('Retry-After')
+                    if retry_after is not None:
+                        retry_after = float(retry_after) + 1.0
+                    else:
+                        retry_after = 1.0 # Default value if 'Retry-After' is not provided
+                    if response.headers.get('X-RateLimit-Global') or response.headers.get('X-RateLimit-Scope') == 'global':
+                        logging.error(f"RateLimitedWebhook encountered global error 429, pausing all webhooks for {float(retry_after)} seconds")
+                        GLOBAL_LIMITER.block(retry_after)
+                        increment('webhook_rate_limited_total', scope='global')
+                    else:
+                        logging.error(f"RateLimitedWebhook encountered error 429, retrying after {float(retry_after)} seconds")
+                        increment('webhook_rate_limited_total', scope='bucket')
+                    self.bucket.reset_time = time.time() + retry_after
+                    self.bucket.remaining_requests = 0
+                    continue
 
-    async def send(self, content=None, embed=None):
-        async with self.lock:
-            if self.remaining_requests == 0 and time.time() < self.reset_time:
-                delay = self.reset_time - time.time()
-                logging.debug(f"RateLimitedWebhook: Waiting for {delay:.2f} seconds due to rate limit")
-                await asyncio.sleep(delay)
-
-            payload = {}
-            if content:
-                payload['content'] = content
-            if embed:
-                payload['embeds'] = [embed.to_dict()]
-
-            logging.debug(f"RateLimitedWebhook: Sending payload: {payload}")
-            response = self.session.post(self.webhook_url, json=payload)
-            logging.debug(f"RateLimitedWebhook: Response status code: {response.status_code}")
-
-            # Call the update_request_count_callback if it's provided
-            if self.update_request_count_callback:
-                self.update_request_count_callback()
-
-            if response.status_code == 429:
-                retry_after = response.headers.get('Retry-After')
-                if retry_after is not None:
-                    retry_after = float(retry_after + 1.0)
-                else:
-                    retry_after = 1.0 # Default value if 'Retry-After' is not provided
-                logging.error(f"RateLimitedWebhook encountered error 429, retrying after {float(retry_after)} seconds")
-                self.reset_time = time.time() + retry_after
-                self.remaining_requests = 0
-                await asyncio.sleep(retry_after)
-                return await self.send(content=content, embed=embed)
-            else:
-                self.remaining_requests = int(response.headers.get('X-RateLimit-Remaining', 0))
-                reset_time_header = response.headers.get('X-RateLimit-Reset')
-                if reset_time_header is not None:
-                    self.reset_time = float(reset_time_header)
-                else:
-                    self.reset_time = 0.0 # Default value if 'X-RateLimit-Reset' is not provided
+                self.bucket.update(response.headers)
+                if response.status >= 400:
+                    # The request itself was rejected (bad embed, payload too large, ...), sending it again won't help
+                    # and the webhook isn't at fault, so the circuit is left as it is
+                    logging.error(f"RateLimitedWebhook: Webhook {self.webhook_id} rejected the message with status {response.status}: {body[:500].decode(errors='replace')}")
+                    increment('webhook_errors_total', reason='rejected')
+                    raise WebhookRejectedError(f"Webhook {self.webhook_id} rejected the message with status {response.status}")
+                self._record_success()
                 return response
@@ -0,0 +1,123 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import deque
+import discord
+from utils import update_request_count
+
+AUDIT_LOG_TTL = 60  # Seconds an audit log entry can still be matched to an event
+AUDIT_LOG_WAIT = 2.0  # Seconds a handler waits for the gateway to deliver a matching entry
+AUDIT_LOG_FETCH_LIMIT = 50  # Entries read by a fallback fetch, one request covers up to 100
+AUDIT_LOG_FETCH_COOLDOWN = 5  # Minimum seconds between fallback fetches for the same server and action
+
+AUDIT_LOGS = {}  # Dictionary to store the recent audit log entries of each server
+
+def format_audit_log_user(entry):
+    # Entries from the gateway only carry the user's ID when the member isn't cached
+    return f"<@{entry.user_id}> ({entry.user_id})"
+
+class GuildAuditLog:
+    def __init__(self):
+        self.entries = {}  # (action, target ID) -> deque of entries, oldest first
+        self.entry_ids = set()  # Entries seen from both the gateway and a fetch are only indexed once
+        self.expiry = deque()  # (received at, key, entry ID) in arrival order
+        self.waiters = {}  # (action, target ID) -> list of (check, future)
+        self.fetches = {}  # action -> fetch task currently running
+        self.last_fetch = {}  # action -> when the last fallback fetch started
+
+    def _expire(self, now):
+        while self.expiry and now - self.expiry[0][0] > AUDIT_LOG_TTL:
+            _, key, entry_id = self.expiry.popleft()
+            self.entry_ids.discard(entry_id)
+            entries = self.entries.get(key)
+            if entries:
+                entries.popleft()
+                if not entries:
+                    del self.entries[key]
+
+    def add(self, entry):
+        if entry.id in self.entry_ids:
+            return
+        now = time.monotonic()
+        self._expire(now)
+        key = (entry.action, getattr(entry.target, 'id', None))
+        self.entry_ids.add(entry.id)
+        self.expiry.append((now, key, entry.id))
+        self.entries.setdefault(key, deque()).append(entry)
+
+        for check, future in self.waiters.get(key, ()):
+            if not future.done() and (check is None or check(entry)):
+                future.set_result(entry)
+
+    def find(self, action, target_id, check=None):
+        self._expire(time.monotonic())
+        # Newest first, the most recent action on a target is the one that caused the event
+        for entry in reversed(self.entries.get((action, target_id), ())):
+            if check is None or check(entry):
+                return entry
+        return None
+
+    async def fetch(self, guild, action):
+        task = self.fetches.get(action)
+        if task is None:
+            now = time.monotonic()
+            if now - self.last_fetch.get(action, 0) < AUDIT_LOG_FETCH_COOLDOWN:
+                # A fetch just ran, anything it missed will have to come from the gateway
+                return
+            self.last_fetch[action] = now
+            task = self.fetches[action] = asyncio.create_task(self._fetch(guild, action))
+        # Every handler waiting on this action shares the one request
+        await asyncio.shield(task)
+
+    async def _fetch(self, guild, action):
+        try:
+            start_time = time.monotonic()
+            entries = [entry async for entry in guild.audit_logs(limit=AUDIT_LOG_FETCH_LIMIT, action=action)]
+            update_request_count('audit_log', guild.id, latency=time.monotonic() - start_time)
+            oldest_allowed = discord.utils.utcnow() - datetime.timedelta(seconds=AUDIT_LOG_TTL)
+            for entry in reversed(entries):
+                if entry.created_at >= oldest_allowed:
+                    self.add(entry)
+        except discord.HTTPException as e:
+            logging.error(f"Error fetching audit logs for guild {guild.id}: {str(e)}")
+        finally:
+            self.fetches.pop(action, None)
+
+def get_guild_audit_log(guild_id):
+    audit_log = AUDIT_LOGS.get(guild_id)
+    if audit_log is None:
+        audit_log = AUDIT_LOGS[guild_id] = GuildAuditLog()
+    return audit_log
+
+def record_audit_log_entry(entry):
+    get_guild_audit_log(entry.guild.id).add(entry)
+
+async def wait_for_audit_log_entry(guild, action, target_id, check=None):
+    audit_log = get_guild_audit_log(guild.id)
+    entry = audit_log.find(action, target_id, check)
+    if entry:
+        return entry
+
+    # The gateway usually delivers the entry alongside the event, give it a moment to arrive
+    key = (action, target_id)
+    future = asyncio.get_running_loop().create_future()
+    waiter = (check, future)
+    audit_log.waiters.setdefault(key, []).append(waiter)
+    try:
+        return await asyncio.wait_for(future, timeout=AUDIT_LOG_WAIT)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        waiters = audit_log.waiters.get(key)
+        if waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del audit_log.waiters[key]
+
+    # Fall back to one fetch shared by every handler waiting on this action
+    await audit_log.fetch(guild, action)
+    return audit_log.find(action, target_id, check)
+
+def forget_guild_audit_log(guild_id):
+    AUDIT_LOGS.pop(guild_id, None)
@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+import yaml
+from aiohttp import web
+from recorder import read_recording
+
+# Offline benchmark: drives the bot.py event handlers with synthetic servers, members and messages and
+# points every log webhook at a local stub that rate limits like Discord. Nothing talks to Discord or
+# the database, so only events whose handlers don't need the audit log or the message store are generated.
+# Traffic recorded with record_events_path can be replayed instead of the synthetic scenarios.
+
+STUB_HOST = '127.0.0.1'
+WEBHOOK_BUCKET_LIMIT = 5  # Requests per webhook per WEBHOOK_BUCKET_WINDOW, like Discord's webhook buckets
+WEBHOOK_BUCKET_WINDOW = 2.0
+STUB_GLOBAL_LIMIT = 50  # Requests per second across every webhook
+GENERATOR_TICK = 0.01  # Seconds between bursts of generated events
+DRAIN_QUIET_TIME = 0.5  # Seconds the pipeline has to stay idle before the run counts as drained
+AVATAR_URL = 'https://cdn.discordapp.com/embed/avatars/0.png'
+MARKER_PATTERN = re.compile(r'bench-(\d+)')
+# message_delete isn't replayed, its handler only logs when the server gives access to the audit log
+REPLAYED_EVENTS = ('member_join', 'member_remove', 'reaction_add', 'reaction_remove', 'voice_state_update', 'member_update', 'message_edit')
+REPLAY_MAX_GAP = 60  # Recorded seconds, longer gaps (the bot was down between runs) are cut to this
+
+Role = namedtuple('Role', ('name',))
+
+class FakeUser:
+    # Just enough of a discord.Member for the handlers. The name is the marker the stub uses to
+    # match delivered embeds back to the events that caused them
+    def __init__(self, user_id, guild):
+        self.id = user_id
+        self.name = f"bench-{user_id}"
+        self.mention = f"@bench-{user_id}"
+        self.avatar = SimpleNamespace(url=AVATAR_URL)
+        self.guild = guild
+        self.roles = [Role('@everyone')]
+        self.nick = None
+        self.premium_since = None
+
+    def __str__(self):
+        return self.name
+
+def fake_member_update(member):
+    after = FakeUser(member.id, member.guild)
+    after.roles = list(member.roles)
+    after.nick = member.nick
+    return after
+
+class Benchmark:
+    def __init__(self, args, bot, utils, coalesce, RateLimitedWebhook):
+        self.args = args
+        self.bot = bot
+        self.utils = utils
+        self.coalesce = coalesce
+        self.RateLimitedWebhook = RateLimitedWebhook
+        self.rng = random.Random(args.seed)
+        self.next_id = 1_000_000
+        self.guilds = []
+        self.guilds_by_id = {}
+        self.pending = {}  # Marker -> injection times of its events not delivered yet
+        self.latencies = []
+        self.events_generated = 0
+        self.events_delivered = 0
+        self.events_skipped = 0
+        self.handler_tasks = set()
+        # Stub state
+        self.buckets = {}  # Webhook ID -> [window reset at, requests remaining]
+        self.global_reset = 0.0
+        self.global_remaining = STUB_GLOBAL_LIMIT
+        self.requests = 0
+        self.rate_limited = 0
+        self.messages = 0
+        self.embeds = 0
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    # Webhook stub
+
+    async def handle_webhook(self, request):
+        now = time.monotonic()
+        self.requests += 1
+        webhook_id = request.match_info['webhook_id']
+
+        if now >= self.global_reset:
+            self.global_reset = now + 1.0
+            self.global_remaining = STUB_GLOBAL_LIMIT
+        if self.global_remaining <= 0:
+            self.rate_limited += 1
+            retry_after = self.global_reset - now
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': True}, status=429,
+                                     headers={'Retry-After': f"{retry_after:.3f}", 'X-RateLimit-Global': 'true', 'X-RateLimit-Scope': 'global'})
+
+        bucket = self.buckets.get(webhook_id)
+        if bucket is None or now >= bucket[0]:
+            bucket = self.buckets[webhook_id] = [now + WEBHOOK_BUCKET_WINDOW, WEBHOOK_BUCKET_LIMIT]
+        reset_after = bucket[0] - now
+        headers = {
+            'X-RateLimit-Limit': str(WEBHOOK_BUCKET_LIMIT),
+            'X-RateLimit-Reset': f"{time.time() + reset_after:.3f}",
+            'X-RateLimit-Reset-After': f"{reset_after:.3f}",
+            'X-RateLimit-Bucket': f"bench-{webhook_id}",
+        }
+        if bucket[1] <= 0:
+            self.rate_limited += 1
+            headers.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Scope': 'user', 'Retry-After': f"{reset_after:.3f}"})
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': reset_after, 'global': False}, status=429, headers=headers)
+
+        bucket[1] -= 1
+        self.global_remaining -= 1
+        headers['X-RateLimit-Remaining'] = str(bucket[1])
+        payload = await request.json()
+        self.record_delivery(payload.get('embeds', []), now)
+        return web.Response(status=204, headers=headers)
+
+    def record_delivery(self, embeds, received_at):
+        self.messages += 1
+        self.embeds += len(embeds)
+        for embed in embeds:
+            for marker in set(MARKER_PATTERN.findall(json.dumps(embed))):
+                injected = self.pending.pop(marker, None)
+                if injected:
+                    self.events_delivered += len(injected)
+                    self.latencies.extend(received_at - injected_at for injected_at in injected)
+
+    async def start_stub(self):
+        app = web.Application()
+        app.router.add_post('/api/webhooks/{webhook_id}/{token}', self.handle_webhook)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, STUB_HOST, 0).start()
+        return self.runner.addresses[0][1]  # Port 0 let the OS pick a free one
+
+    # Synthetic servers and events
+
+    def add_guild(self, guild_id):
+        guild = SimpleNamespace(id=guild_id, name=f"guild-{guild_id}")
+        log_channel = SimpleNamespace(id=self.new_id(), name='log', guild=guild)
+        self.utils.set_log_events(guild_id, self.utils.LOG_EVENTS)
+        self.utils.set_log_channel(guild_id, log_channel)
+        self.utils.get_guild_route(guild_id).audit_log_access = False
+        self.utils.set_log_webhooks(guild_id, [f"http://{STUB_HOST}:{self.port}/api/webhooks/{self.new_id()}/bench" for _ in range(self.args.webhooks)])
+        self.guilds.append(guild)
+        self.guilds_by_id[guild_id] = guild
+        return guild
+
+    def setup_guilds(self):
+        for _ in range(self.args.guilds):
+            guild = self.add_guild(self.new_id())
+            guild.voice_channels = [SimpleNamespace(id=self.new_id(), name='voice', mention=f"<#{guild.id}-voice-{index}>", guild=guild) for index in range(3)]
+            guild.messages = [SimpleNamespace(id=self.new_id(), guild=guild, jump_url=f"https://discord.com/channels/{guild.id}/0/{index}") for index in range(5)]
+            guild.members = [FakeUser(self.new_id(), guild) for _ in range(self.args.members)]
+            guild.voice = {}  # Member ID -> voice channel they're in
+            guild.reactions = []  # (user, message, emoji) currently on a message
+
+    def pick_guild(self):
+        # A few servers get most of the traffic, like in production
+        if self.args.guilds == 1:
+            return self.guilds[0]
+        return self.guilds[min(int(self.rng.paretovariate(1.2)) - 1, len(self.guilds) - 1)]
+
+    def raid_event(self, guild):
+        member = FakeUser(self.new_id(), guild)
+        return self.bot.on_member_join, (member,), member
+
+    def reaction_event(self, guild):
+        # Most reactions are added, some are taken away again by the same user
+        if guild.reactions and self.rng.random() < 0.3:
+            user, message, emoji = guild.reactions.pop(self.rng.randrange(len(guild.reactions)))
+            return self.bot.on_reaction_remove, (SimpleNamespace(emoji=emoji, message=message), user), user
+        user = self.rng.choice(guild.members)
+        message = self.rng.choice(guild.messages)
+        emoji = self.rng.choice(('👍', '😂', '🎉', '❤️'))
+        guild.reactions.append((user, message, emoji))
+        return self.bot.on_reaction_add, (SimpleNamespace(emoji=emoji, message=message), user), user
+
+    def voice_event(self, guild):
+        # Members hop in, out and between voice channels
+        member = self.rng.choice(guild.members)
+        before_channel = guild.voice.get(member.id)
+        if before_channel is None:
+            after_channel = self.rng.choice(guild.voice_channels)
+        elif self.rng.random() < 0.5:
+            after_channel = None
+        else:
+            after_channel = self.rng.choice([channel for channel in guild.voice_channels if channel is not before_channel] or [None])
+        if after_channel is None:
+            guild.voice.pop(member.id, None)
+        else:
+            guild.voice[member.id] = after_channel
+        return self.bot.on_voice_state_update, (member, SimpleNamespace(channel=before_channel), SimpleNamespace(channel=after_channel)), member
+
+    def member_update_event(self, guild):
+        # Roles and nicknames changing, sometimes back and forth
+        member = self.rng.choice(guild.members)
+        before = fake_member_update(member)
+        after = fake_member_update(member)
+        if self.rng.random() < 0.5:
+            role = Role(f"role-{self.rng.randrange(5)}")
+            after.roles = [existing for existing in member.roles if existing != role] if role in member.roles else member.roles + [role]
+        else:
+            after.nick = None if member.nick else f"nick-{self.rng.randrange(100)}"
+        member.roles, member.nick = after.roles, after.nick  # The next update starts from this one
+        return self.bot.on_member_update, (before, after), member
+
+    def make_event(self):
+        generators = {
+            'raid': self.raid_event,
+            'reactions': self.reaction_event,
+            'voice': self.voice_event,
+            'member_update': self.member_update_event,
+        }
+        scenario = self.args.scenario
+        if scenario == 'mixed':
+            scenario = self.rng.choices(('raid', 'reactions', 'voice', 'member_update'), weights=(1, 5, 3, 2))[0]
+        return generators[scenario](self.pick_guild())
+
+    def inject(self, handler, args, marker_user):
+        self.pending.setdefault(str(marker_user.id), []).append(time.monotonic())
+        self.events_generated += 1
+        # discord.py runs every handler in a task of its own
+        task = asyncio.create_task(handler(*args))
+        self.handler_tasks.add(task)
+        task.add_done_callback(self.handler_tasks.discard)
+
+    async def generate(self):
+        start_time = time.monotonic()
+        owed = 0.0
+        while time.monotonic() - start_time < self.args.duration:
+            await asyncio.sleep(GENERATOR_TICK)
+            owed += self.args.rate * GENERATOR_TICK
+            while owed >= 1:
+                owed -= 1
+                self.inject(*self.make_event())
+        return time.monotonic() - start_time
+
+    # Recorded traffic
+
+    def replay_guild(self, guild_id):
+        guild = self.guilds_by_id.get(guild_id)
+        if guild is None:
+            guild = self.add_guild(guild_id)
+            guild.members = {}
+            guild.channels = {}
+            guild.messages = {}
+        return guild
+
+    def replay_member(self, guild, user_id):
+        member = guild.members.get(user_id)
+        if member is None:
+            member = guild.members[user_id] = FakeUser(user_id, guild)
+        return member
+
+    def replay_channel(self, guild, channel_id):
+        if channel_id is None:
+            return None
+        channel = guild.channels.get(channel_id)
+        if channel is None:
+            channel = guild.channels[channel_id] = SimpleNamespace(id=channel_id, name='channel', mention=f"<#{channel_id}>", guild=guild)
+        return channel
+
+    def replay_message(self, guild, message_id):
+        message = guild.messages.get(message_id)
+        if message is None:
+            message = guild.messages[message_id] = SimpleNamespace(id=message_id, guild=guild, jump_url=f"https://discord.com/channels/{guild.id}/0/{message_id}")
+        return message
+
+    def recorded_event(self, event_name, guild_id, payload):
+        # Rebuilds the handler arguments from a recorded payload. Content was scrubbed down to its length
+        guild = self.replay_guild(guild_id)
+        member = self.replay_member(guild, payload['u'])
+        if event_name in ('member_join', 'member_remove'):
+            args = (member,)
+        elif event_name in ('reaction_add', 'reaction_remove'):
+            args = (SimpleNamespace(emoji=payload['e'], message=self.replay_message(guild, payload['m'])), member)
+        elif event_name == 'voice_state_update':
+            args = (member, SimpleNamespace(channel=self.replay_channel(guild, payload['b'])), SimpleNamespace(channel=self.replay_channel(guild, payload['a'])))
+        elif event_name == 'member_update':
+            before = fake_member_update(member)
+            after = fake_member_update(member)
+            before.roles = [Role(f"role-{role_id}") for role_id in payload['rb']]
+            after.roles = [Role(f"role-{role_id}") for role_id in payload['ra']]
+            if payload['n']:
+                after.nick = None if member.nick else f"nick-{member.id}"
+            member.roles, member.nick = after.roles, after.nick
+            args = (before, after)
+        else:
+            channel = self.replay_channel(guild, payload['c'])
+            args = tuple(SimpleNamespace(content='x' * length, author=member, channel=channel, guild=guild) for length in (payload['lb'], payload['la']))
+        return getattr(self.bot, f"on_{event_name}"), args, member
+
+    async def replay(self):
+        # Events are injected at their recorded times after the first one, divided by --speed
+        start_time = time.monotonic()
+        elapsed = 0.0
+        last_time = None
+        for recorded_at, event_name, guild_id, payload in read_recording(self.args.replay):
+            if event_name not in REPLAYED_EVENTS:
+                # Their handlers need Discord, the audit log or the database
+                self.events_skipped += 1
+                continue
+            if last_time is not None:
+                elapsed += min(max(recorded_at - last_time, 0), REPLAY_MAX_GAP)
+            last_time = recorded_at
+            delay = start_time + elapsed / self.args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.inject(*self.recorded_event(event_name, guild_id, payload))
+        return time.monotonic() - start_time
+
+    def is_idle(self):
+        return not (self.handler_tasks or self.utils.SCHEDULED_GUILDS or self.utils.EVENT_BATCHES or self.utils.DEFERRED_EVENTS or self.coalesce.COALESCED_EVENTS)
+
+    async def drain(self):
+        deadline = time.monotonic() + self.args.drain_timeout
+        idle_since = None
+        while time.monotonic() < deadline:
+            if self.is_idle():
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since >= DRAIN_QUIET_TIME:
+                    return True
+            else:
+                idle_since = None
+            await asyncio.sleep(0.05)
+        return False
+
+    async def run(self):
+        self.port = await self.start_stub()
+        if not self.args.replay:
+            self.setup_guilds()
+        self.utils.RAMP_UP_FACTOR = 1.0  # Measure the steady state, not the batching right after startup
+        self.utils.start_delivery_workers()
+
+        start_time = time.monotonic()
+        generate_time = await (self.replay() if self.args.replay else self.generate())
+        drained = await self.drain()
+        total_time = time.monotonic() - start_time
+
+        await self.RateLimitedWebhook.get_session().close()
+        await self.runner.cleanup()
+        self.report(generate_time, total_time, drained)
+
+    def report(self, generate_time, total_time, drained):
+        latencies = sorted(self.latencies)
+
+        def percentile(quantile):
+            if not latencies:
+                return float('nan')
+            return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Kilobytes on Linux
+        if self.args.replay:
+            print(f"Replay:              {self.args.replay} at {self.args.speed}x, {len(self.guilds)} servers with {self.args.webhooks} webhook(s) each")
+        else:
+            print(f"Scenario:            {self.args.scenario}, {self.args.guilds} servers with {self.args.webhooks} webhook(s) each, {self.args.rate} events/s for {self.args.duration}s")
+        print(f"Events generated:    {self.events_generated} ({self.events_generated / generate_time:.1f}/s)")
+        if self.events_skipped:
+            print(f"Events skipped:      {self.events_skipped} (their handlers need Discord, the audit log or the database)")
+        print(f"Events delivered:    {self.events_delivered} ({self.events_delivered / total_time:.1f}/s end to end)")
+        print(f"Merged or cancelled: {self.events_generated - self.events_delivered}")
+        print(f"Latency:             p50 {percentile(0.5) * 1000:.0f}ms, p99 {percentile(0.99) * 1000:.0f}ms, max {percentile(1.0) * 1000:.0f}ms")
+        print(f"Webhook requests:    {self.requests} ({self.rate_limited} rate limited), {self.messages} messages carrying {self.embeds} embeds")
+        print(f"Peak memory:         {peak_memory:.1f} MB")
+        if not drained:
+            print(f"Warning: the pipeline was still busy after {self.args.drain_timeout}s, the numbers above are incomplete")
+
+def write_config(args):
+    # bot.py reads config.yaml from the working directory on import, give it one that needs no database
+    workdir = tempfile.mkdtemp(prefix='loggerhead-bench-')
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as file:
+        yaml.safe_dump({
+            'discord_token': 'benchmark',
+            'db_host': 'localhost',
+            'db_user': 'benchmark',
+            'db_password': 'benchmark',
+            'db_name': 'benchmark',
+            'coalesce_window': args.coalesce_window,
+            'outbox_path': '',
+        }, file)
+    os.chdir(workdir)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the logging pipeline against a local webhook stub.")
+    parser.add_argument('--scenario', choices=('raid', 'reactions', 'voice', 'member_update', 'mixed'), default='mixed')
+    parser.add_argument('--rate', type=float, default=200, help="Events generated per second")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to generate events for")
+    parser.add_argument('--guilds', type=int, default=20, help="Number of synthetic servers")
+    parser.add_argument('--members', type=int, default=200, help="Members in each synthetic server")
+    parser.add_argument('--webhooks', type=int, default=1, help="Webhooks in each server's log channel pool")
+    parser.add_argument('--coalesce-window', type=float, default=10, help="Seconds events are coalesced over, 0 to turn it off")
+    parser.add_argument('--drain-timeout', type=float, default=120, help="Seconds to wait for queued events after generation stops")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', metavar='FILE', help="Replay traffic recorded with record_events_path instead of generating it")
+    parser.add_argument('--speed', type=float, default=1, help="How many times faster than recorded to replay")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    write_config(args)
+    # Imported after config.yaml is in place
+    import bot
+    import coalesce
+    import utils
+    import RateLimitedWebhook
+    asyncio.run(Benchmark(args, bot, utils, coalesce, RateLimitedWebhook).run())
+
+if __name__ == '__main__':
+    main()
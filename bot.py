@@ -1,10 +1,16 @@
 import aiohttp
-import asyncio
 import discord
 from discord.ext import commands
 import logging
-from config import get_config, set_config, remove_config, create_config_table, set_webhook_url, LOG_EVENTS
-from utils import is_event_enabled, log_event, print_request_counts, ramp_up_logging, send_pending_batches, update_request_count, LOG_CHANNELS, LOG_EVENT_SETTINGS, LOG_WEBHOOKS
+from config import events_to_mask, get_config, get_configs, set_config, set_default_configs, remove_config, create_config_table, set_webhook_url, close_db_pool, monitor_db_health, listen_for_config_changes, LOG_EVENTS, WEBHOOK_CONNECTION_LIMIT, WEBHOOK_CONNECTION_LIMIT_PER_HOST, METRICS_HOST, METRICS_PORT, DISCORD_MAX_MESSAGES, SHARD_COUNT, SHARD_PROCESSES, SHARD_IDS, PROCESS_INDEX, COALESCE_WINDOW, OUTBOX_PATH, RECORD_EVENTS_PATH, WEBHOOKS_PER_CHANNEL
+from RateLimitedWebhook import configure_global_rate_limit, configure_session, GLOBAL_RATE_LIMIT
+from metrics import increment, start_metrics_server
+from message_store import create_message_table, get_message, get_messages, start_message_store, store_message, update_message_content
+from coalesce import coalesce_event
+from outbox import open_outbox
+from recorder import install_recorder, start_recorder, RECORDED_EVENTS
+from audit_log import format_audit_log_user, forget_guild_audit_log, record_audit_log_entry, wait_for_audit_log_entry
+from utils import truncate, get_event_route, is_logging_any, set_log_events, set_log_channel, set_log_webhooks, forget_guild_route, invalidate_audit_log_access, get_guild_route, queue_event, start_delivery_workers, heal_webhook, set_webhook_healer, print_request_counts, start_ramp_up, replay_events, update_request_count
 
 intents = discord.Intents.default()
 intents.members = True
@@ -12,239 +18,352 @@ intents.message_content = True
 intents.voice_states = True
 intents.guild_messages = True
 intents.guild_reactions = True
+intents.moderation = True  # Needed for on_audit_log_entry_create
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Deletes and edits of messages that fall out of this cache are still logged from message_store
+if SHARD_COUNT:
+    # shard_ids of None runs every shard in this process
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, max_messages=DISCORD_MAX_MESSAGES, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, max_messages=DISCORD_MAX_MESSAGES)
+
+BACKGROUND_TASKS = []  # Tasks bot.py started for the life of the process
+BACKGROUND_TASKS_STARTED = False
+BULK_DELETE_LINE_LENGTH = 200  # Characters of each message shown in a bulk delete log entry
+MESSAGE_EVENTS_MASK = events_to_mask(['message_delete', 'message_edit'])  # Events that need a copy of each message
+LOG_WEBHOOK_NAME = "LoggerHead"
+
+if RECORD_EVENTS_PATH:
+    install_recorder(bot, RECORD_EVENTS_PATH if SHARD_PROCESSES <= 1 else f"{RECORD_EVENTS_PATH}.{PROCESS_INDEX}", RECORDED_EVENTS)
 
 @bot.event
 async def on_ready():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     logging.info(f'{bot.user} has connected to Discord!')
+    configure_session(limit=WEBHOOK_CONNECTION_LIMIT, limit_per_host=WEBHOOK_CONNECTION_LIMIT_PER_HOST)
+    if SHARD_IDS is not None:
+        # main.py only gives this process its shards when it splits them across processes. Every server
+        # belongs to one shard, so webhook buckets are never shared between processes, only the global limit is
+        configure_global_rate_limit(GLOBAL_RATE_LIMIT / SHARD_PROCESSES)
+        logging.info(f"Process {PROCESS_INDEX} running shards {SHARD_IDS} of {SHARD_COUNT}")
     try:
-        create_config_table()
+        await create_config_table()
+        await create_message_table()
         
+        # Load every server's configuration with one query instead of one per server
+        configs = await get_configs([guild.id for guild in bot.guilds])
+        default_configs = []
         for guild in bot.guilds:
-            config = get_config(guild.id)
-            if config:
-                log_channel_name, log_events_str, webhook_url = config
-                if log_events_str:
-                    log_events = log_events_str.split(',')
-                    LOG_EVENT_SETTINGS[guild.id] = set(log_events)
-                    log_channel = discord.utils.get(guild.channels, name=log_channel_name)
-                    if log_channel:
-                        LOG_CHANNELS[guild.id] = log_channel
-                        if webhook_url:
-                            LOG_WEBHOOKS[guild.id] = webhook_url
-                        logging.debug(f"Logging channel for server {guild.name} set to: {log_channel.name}")
-                    else:
-                        logging.debug(f"Logging channel '{log_channel_name}' not found in server {guild.name}.")
-                else:
-                    LOG_EVENT_SETTINGS[guild.id] = set(LOG_EVENTS)  # Set default logging events
-                    set_config(guild.id, log_channel_name, ','.join(LOG_EVENTS))  # Update the configuration with default events
-                    logging.debug(f"No logging events configured for server {guild.name}. Using default settings.")
-            else:
-                LOG_EVENT_SETTINGS[guild.id] = set(LOG_EVENTS)  # Set default logging events
-                set_config(guild.id, None, ','.join(LOG_EVENTS))  # Set default configuration
-                logging.debug(f"No configuration found for server {guild.name}. Using default settings.")
+            config = configs.get(guild.id)
+            if not apply_guild_config(guild, config):
+                default_configs.append((guild.id, config[0] if config else None))  # Update the configuration with default events
+        
+        # Write the defaults for every server that needed them in one statement
+        await set_default_configs(default_configs, ','.join(LOG_EVENTS))
     except Exception as e:
         logging.error(f"An error occurred in the on_ready event: {str(e)}")
         await bot.close()  # Terminate the bot if there's an error
         return
     
-    bot.loop.create_task(print_request_counts())
-    bot.loop.create_task(send_pending_batches())
-    bot.loop.create_task(ramp_up_logging())
+    await start_background_tasks()
+
+async def start_background_tasks():
+    # on_ready fires again after every reconnect. This is the one place that makes sure the tasks that
+    # run for the life of the process start only once, the start functions it calls don't check
+    global BACKGROUND_TASKS_STARTED
+    if BACKGROUND_TASKS_STARTED:
+        return
+    BACKGROUND_TASKS_STARTED = True
+    BACKGROUND_TASKS.append(bot.loop.create_task(print_request_counts()))
+    start_ramp_up()
+    BACKGROUND_TASKS.append(bot.loop.create_task(monitor_db_health()))
+    BACKGROUND_TASKS.append(bot.loop.create_task(listen_for_config_changes(refresh_guild_configs)))
+    start_delivery_workers()
+    if OUTBOX_PATH:
+        try:
+            # Shard processes each keep their own outbox
+            entries = await open_outbox(OUTBOX_PATH if SHARD_PROCESSES <= 1 else f"{OUTBOX_PATH}.{PROCESS_INDEX}")
+            BACKGROUND_TASKS.append(bot.loop.create_task(replay_events(entries)))
+        except Exception as e:
+            logging.error(f"Error opening the outbox, queued events won't survive a restart: {str(e)}")
+    start_recorder()
+    start_message_store()
+    if METRICS_PORT:
+        # Each shard process serves its own metrics on the next port up
+        await start_metrics_server(METRICS_HOST, METRICS_PORT + PROCESS_INDEX)
+
+def apply_guild_config(guild, config):
+    # Returns False when the server has no logging events set yet and needs the defaults written
+    log_channel_name, log_events_str, webhook_urls = config or (None, None, [])
+    if log_events_str is None:
+        set_log_events(guild.id, LOG_EVENTS)  # Set default logging events
+        logging.debug(f"No logging events configured for server {guild.name}. Using default settings.")
+    else:
+        set_log_events(guild.id, log_events_str.split(',') if log_events_str else [])
+
+    log_channel = discord.utils.get(guild.channels, name=log_channel_name) if log_channel_name else None
+    set_log_channel(guild.id, log_channel)
+    set_log_webhooks(guild.id, webhook_urls if log_channel else [])
+    if log_channel:
+        logging.debug(f"Logging channel for server {guild.name} set to: {log_channel.name}")
+    elif log_channel_name:
+        logging.debug(f"Logging channel '{log_channel_name}' not found in server {guild.name}.")
+    return log_events_str is not None
+
+async def refresh_guild_configs(guild_ids):
+    # Reload servers whose configuration changed, possibly in another bot process. None reloads every server
+    guilds = bot.guilds if guild_ids is None else [bot.get_guild(guild_id) for guild_id in guild_ids]
+    guilds = [guild for guild in guilds if guild is not None]  # Servers this process doesn't serve are skipped
+    if not guilds:
+        return
+    configs = await get_configs([guild.id for guild in guilds])
+    for guild in guilds:
+        apply_guild_config(guild, configs.get(guild.id))
+    logging.debug(f"Reloaded the configuration of {len(guilds)} servers.")
 
 def has_permission(channel, user, permission):
     user_permissions = channel.permissions_for(user)
     return getattr(user_permissions, permission)
 
+async def find_log_webhooks(channel):
+    return [hook for hook in await channel.webhooks() if hook.name == LOG_WEBHOOK_NAME]
+
+async def create_log_webhook(log_channel):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(bot.user.avatar.url) as response:
+            avatar_bytes = await response.read()
+    return await log_channel.create_webhook(name=LOG_WEBHOOK_NAME, avatar=avatar_bytes)
+
+async def create_log_webhooks(log_channel):
+    # Reuses the channel's Logging Webhooks if it already has them and creates the rest of the pool
+    webhooks = (await find_log_webhooks(log_channel))[:WEBHOOKS_PER_CHANNEL]
+    while len(webhooks) < WEBHOOKS_PER_CHANNEL:
+        webhooks.append(await create_log_webhook(log_channel))
+    return webhooks
+
+async def delete_log_webhooks(channel):
+    for webhook in await find_log_webhooks(channel):
+        await webhook.delete()
+
+async def save_log_webhooks(guild_id, webhook_urls):
+    set_log_webhooks(guild_id, webhook_urls)
+    await set_webhook_url(guild_id, webhook_urls[0], webhook_urls[1:])  # Update the webhook URLs in the database
+
+async def recreate_log_webhook(guild_id, dead_webhook):
+    # Called by utils when a webhook of the pool was deleted or its token revoked
+    route = get_guild_route(guild_id)
+    log_channel = route.log_channel
+    if log_channel is None or not has_permission(log_channel, log_channel.guild.me, 'manage_webhooks'):
+        logging.warning(f"recreate_log_webhook: Guild ID: {guild_id}, Unable to manage webhooks in the log channel, not replacing the webhook")
+        return None
+    pool_urls = [webhook.webhook_url for webhook in route.webhooks]
+    if dead_webhook.webhook_url not in pool_urls:
+        return route.webhook  # Already replaced, or the pool was reconfigured meanwhile
+
+    # A spare Logging Webhook left in the channel is used before creating another one
+    replacement = None
+    for hook in await find_log_webhooks(log_channel):
+        if hook.url == dead_webhook.webhook_url:
+            await hook.delete()  # Still listed in the channel but refusing our requests
+        elif hook.url not in pool_urls and replacement is None:
+            replacement = hook
+    if replacement is None:
+        replacement = await create_log_webhook(log_channel)
+
+    # Read the pool again, it may have changed while we waited on Discord
+    pool_urls = [replacement.url if webhook.webhook_url == dead_webhook.webhook_url else webhook.webhook_url for webhook in route.webhooks]
+    await save_log_webhooks(guild_id, pool_urls)
+    increment('webhooks_replaced_total')
+    logging.info(f"recreate_log_webhook: Guild ID: {guild_id}, Replaced a log webhook in #{log_channel.name}")
+    return next((webhook for webhook in route.webhooks if webhook.webhook_url == replacement.url), None)
+
+set_webhook_healer(recreate_log_webhook)
+
+@bot.listen('on_message')
+async def cache_message(message):
+    # Keep a copy of messages so deletes and edits can still be logged after a restart
+    if message.guild and not message.webhook_id and is_logging_any(message.guild.id, MESSAGE_EVENTS_MASK):
+        store_message(message)
+
+# Our permission to view the audit log is cached per server, these are the changes that can affect it
+@bot.listen('on_guild_role_delete')
+async def role_deleted(role):
+    invalidate_audit_log_access(role.guild.id)
+
+@bot.listen('on_guild_role_update')
+async def role_updated(before, after):
+    if before.permissions != after.permissions:
+        invalidate_audit_log_access(after.guild.id)
+
+@bot.listen('on_guild_channel_update')
+async def channel_permissions_changed(before, after):
+    if before.overwrites != after.overwrites:
+        invalidate_audit_log_access(after.guild.id)
+
+@bot.listen('on_member_update')
+async def own_roles_changed(before, after):
+    if after.id == bot.user.id and before.roles != after.roles:
+        invalidate_audit_log_access(after.guild.id)
+
 @bot.event
 async def on_disconnect():
-    from config import close_db_connection
-    close_db_connection()
+    await close_db_pool()
     logging.warning("Bot disconnected.")
 
 @bot.event
-async def on_guild_channel_create(channel):
-    if not is_event_enabled(channel.guild.id, 'guild_channel_create'):
-        return
+async def on_audit_log_entry_create(entry):
+    # Index entries as they arrive so handlers can attribute events without fetching the audit log
+    record_audit_log_entry(entry)
 
-    log_channel = LOG_CHANNELS.get(channel.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in channel.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_create):
-            update_request_count()
-            if entry.target.id == channel.id:
-                if isinstance(channel, discord.CategoryChannel):
-                    embed = discord.Embed(title=f"Category created: {channel.name}", color=discord.Color.green())
-                else:
-                    embed = discord.Embed(title=f"Channel created: {channel.mention}", color=discord.Color.green())
-                    embed.add_field(name="Category", value=channel.category.name if channel.category else "None")
-                embed.add_field(name="Created by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="ID", value=channel.id)
+@bot.event
+async def on_guild_channel_create(channel):
+    route = get_event_route(channel.guild.id, 'guild_channel_create')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(channel.guild, discord.AuditLogAction.channel_create, channel.id)
+        if entry:
+            if isinstance(channel, discord.CategoryChannel):
+                embed = discord.Embed(title=f"Category created: {channel.name}", color=discord.Color.green())
+            else:
+                embed = discord.Embed(title=f"Channel created: {channel.mention}", color=discord.Color.green())
+                embed.add_field(name="Category", value=channel.category.name if channel.category else "None")
+            embed.add_field(name="Created by", value=format_audit_log_user(entry))
+            embed.add_field(name="ID", value=channel.id)
                 
-                # Include role and permission information
-                roles_with_perms = []
-                for role in channel.guild.roles:
-                    role_perms = channel.overwrites_for(role).pair()
-                    if role_perms[0] or role_perms[1]:
-                        roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
+            # Include role and permission information
+            roles_with_perms = []
+            for role in channel.guild.roles:
+                role_perms = channel.overwrites_for(role).pair()
+                if role_perms[0] or role_perms[1]:
+                    roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
                 
-                if roles_with_perms:
-                    embed.add_field(name="Role Permissions", value="\n".join(roles_with_perms), inline=False)
+            if roles_with_perms:
+                embed.add_field(name="Role Permissions", value="\n".join(roles_with_perms), inline=False)
                 
-                asyncio.create_task(log_event(channel.guild.id, 'guild_channel_create', embed))
-                break
+            await queue_event(channel.guild.id, 'guild_channel_create', embed)
 
 @bot.event
 async def on_guild_channel_delete(channel):
-    if not is_event_enabled(channel.guild.id, 'guild_channel_delete'):
-        return
-
-    log_channel = LOG_CHANNELS.get(channel.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in channel.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_delete):
-            update_request_count()
-            if entry.target.id == channel.id:
-                if isinstance(channel, discord.CategoryChannel):
-                    embed = discord.Embed(title=f"Category deleted: {channel.name}", color=discord.Color.red())
-                else:
-                    embed = discord.Embed(title=f"Channel deleted: {channel.name}", color=discord.Color.red())
-                    embed.add_field(name="Category", value=channel.category.name if channel.category else "None")
-                embed.add_field(name="Deleted by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="ID", value=channel.id)
-                asyncio.create_task(log_event(channel.guild.id, 'guild_channel_delete', embed))
-                break
+    route = get_event_route(channel.guild.id, 'guild_channel_delete')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(channel.guild, discord.AuditLogAction.channel_delete, channel.id)
+        if entry:
+            if isinstance(channel, discord.CategoryChannel):
+                embed = discord.Embed(title=f"Category deleted: {channel.name}", color=discord.Color.red())
+            else:
+                embed = discord.Embed(title=f"Channel deleted: {channel.name}", color=discord.Color.red())
+                embed.add_field(name="Category", value=channel.category.name if channel.category else "None")
+            embed.add_field(name="Deleted by", value=format_audit_log_user(entry))
+            embed.add_field(name="ID", value=channel.id)
+            await queue_event(channel.guild.id, 'guild_channel_delete', embed)
 
 @bot.event
 async def on_guild_channel_update(before, after):
-    if not is_event_enabled(before.guild.id, 'guild_channel_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(before.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in before.guild.audit_logs(limit=1, action=discord.AuditLogAction.channel_update):
-            update_request_count()
-            if entry.target.id == before.id:
-                if before.name != after.name:
-                    if isinstance(after, discord.CategoryChannel):
-                        embed = discord.Embed(title="Category name updated", color=discord.Color.blue())
-                    else:
-                        embed = discord.Embed(title="Channel name updated", color=discord.Color.blue())
-                    embed.add_field(name="Channel", value=after.mention)
-                    embed.add_field(name="Before", value=before.name, inline=False)
-                    embed.add_field(name="After", value=after.name, inline=False)
-                    asyncio.create_task(log_event(before.guild.id, 'guild_channel_update', embed))
-
-                if before.category != after.category:
-                    embed = discord.Embed(title="Channel category updated", color=discord.Color.blue())
-                    embed.add_field(name="Channel", value=after.mention)
-                    embed.add_field(name="Before", value=before.category.name if before.category else "None", inline=False)
-                    embed.add_field(name="After", value=after.category.name if after.category else "None", inline=False)
-                    asyncio.create_task(log_event(before.guild.id, 'guild_channel_update', embed))
-                
-                # Check for permission changes
-                before_roles_with_perms = []
-                for role in before.guild.roles:
-                    role_perms = before.overwrites_for(role).pair()
-                    if role_perms[0] or role_perms[1]:
-                        before_roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
+    route = get_event_route(before.guild.id, 'guild_channel_update')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(before.guild, discord.AuditLogAction.channel_update, before.id)
+        if entry:
+            if before.name != after.name:
+                if isinstance(after, discord.CategoryChannel):
+                    embed = discord.Embed(title="Category name updated", color=discord.Color.blue())
+                else:
+                    embed = discord.Embed(title="Channel name updated", color=discord.Color.blue())
+                embed.add_field(name="Channel", value=after.mention)
+                embed.add_field(name="Before", value=before.name, inline=False)
+                embed.add_field(name="After", value=after.name, inline=False)
+                await queue_event(before.guild.id, 'guild_channel_update', embed)
+
+            if before.category != after.category:
+                embed = discord.Embed(title="Channel category updated", color=discord.Color.blue())
+                embed.add_field(name="Channel", value=after.mention)
+                embed.add_field(name="Before", value=before.category.name if before.category else "None", inline=False)
+                embed.add_field(name="After", value=after.category.name if after.category else "None", inline=False)
+                await queue_event(before.guild.id, 'guild_channel_update', embed)
                 
-                after_roles_with_perms = []
-                for role in after.guild.roles:
-                    role_perms = after.overwrites_for(role).pair()
-                    if role_perms[0] or role_perms[1]:
-                        after_roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
+            # Check for permission changes
+            before_roles_with_perms = []
+            for role in before.guild.roles:
+                role_perms = before.overwrites_for(role).pair()
+                if role_perms[0] or role_perms[1]:
+                    before_roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
                 
-                if before_roles_with_perms != after_roles_with_perms:
-                    embed = discord.Embed(title="Channel permissions updated", color=discord.Color.blue())
-                    embed.add_field(name="Channel", value=after.mention)
-                    embed.add_field(name="Before", value="\n".join(before_roles_with_perms) or "None", inline=False)
-                    embed.add_field(name="After", value="\n".join(after_roles_with_perms) or "None", inline=False)
-                    asyncio.create_task(log_event(before.guild.id, 'guild_channel_update', embed))
+            after_roles_with_perms = []
+            for role in after.guild.roles:
+                role_perms = after.overwrites_for(role).pair()
+                if role_perms[0] or role_perms[1]:
+                    after_roles_with_perms.append(f"{role.mention}: {', '.join(perm for perm, value in role_perms if value)}")
                 
-                break
+            if before_roles_with_perms != after_roles_with_perms:
+                embed = discord.Embed(title="Channel permissions updated", color=discord.Color.blue())
+                embed.add_field(name="Channel", value=after.mention)
+                embed.add_field(name="Before", value="\n".join(before_roles_with_perms) or "None", inline=False)
+                embed.add_field(name="After", value="\n".join(after_roles_with_perms) or "None", inline=False)
+                await queue_event(before.guild.id, 'guild_channel_update', embed)
 
 @bot.event
 async def on_guild_emojis_update(guild, before, after):
-    if not is_event_enabled(guild.id, 'guild_emojis_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(guild.id)
-    if log_channel:
+    route = get_event_route(guild.id, 'guild_emojis_update')
+    if route is not None:
         if len(before) < len(after):
             new_emoji = next(emoji for emoji in after if emoji not in before)
             embed = discord.Embed(title="Emoji created", color=discord.Color.green())
             embed.add_field(name="Name", value=new_emoji.name)
             embed.add_field(name="ID", value=new_emoji.id)
             embed.set_thumbnail(url=new_emoji.url)
-            asyncio.create_task(log_event(guild.id, 'guild_emojis_update', embed))
+            await queue_event(guild.id, 'guild_emojis_update', embed)
         elif len(before) > len(after):
             removed_emoji = next(emoji for emoji in before if emoji not in after)
             embed = discord.Embed(title="Emoji deleted", color=discord.Color.red())
             embed.add_field(name="Name", value=removed_emoji.name)
             embed.add_field(name="ID", value=removed_emoji.id)
-            asyncio.create_task(log_event(guild.id, 'guild_emojis_update', embed))
+            await queue_event(guild.id, 'guild_emojis_update', embed)
 
 @bot.event
 async def on_guild_join(guild):
     default_log_events = ','.join(LOG_EVENTS)
-    LOG_EVENT_SETTINGS[guild.id] = set(LOG_EVENTS)
-    set_config(guild.id, 'log', default_log_events)
+    set_log_events(guild.id, LOG_EVENTS)
+    await set_config(guild.id, 'log', default_log_events)
     logging.debug(f"Joined server {guild.name}. Set default configuration.")
 
 @bot.event
 async def on_guild_remove(guild):
-    if guild.id in LOG_CHANNELS:
-        del LOG_CHANNELS[guild.id]
-        del LOG_EVENT_SETTINGS[guild.id]
-        remove_config(guild.id)
+    route = forget_guild_route(guild.id)
+    if route and route.log_channel:
+        forget_guild_audit_log(guild.id)
+        await remove_config(guild.id)
         logging.debug(f"Removed logging channel entry and configuration for server {guild.name}.")
 
 @bot.event
 async def on_guild_role_create(role):
-    if not is_event_enabled(role.guild.id, 'guild_role_create'):
-        return
-
-    log_channel = LOG_CHANNELS.get(role.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in role.guild.audit_logs(limit=1, action=discord.AuditLogAction.role_create):
-            update_request_count()
-            if entry.target.id == role.id:
-                embed = discord.Embed(title=f"Role created: {role.name}", color=discord.Color.green())
-                embed.add_field(name="Created by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="Role ID", value=role.id)
-                asyncio.create_task(log_event(role.guild.id, 'guild_role_create', embed))
-                break
+    route = get_event_route(role.guild.id, 'guild_role_create')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(role.guild, discord.AuditLogAction.role_create, role.id)
+        if entry:
+            embed = discord.Embed(title=f"Role created: {role.name}", color=discord.Color.green())
+            embed.add_field(name="Created by", value=format_audit_log_user(entry))
+            embed.add_field(name="Role ID", value=role.id)
+            await queue_event(role.guild.id, 'guild_role_create', embed)
 
 @bot.event
 async def on_guild_role_delete(role):
-    if not is_event_enabled(role.guild.id, 'guild_role_delete'):
-        return
-
-    log_channel = LOG_CHANNELS.get(role.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in role.guild.audit_logs(limit=1, action=discord.AuditLogAction.role_delete):
-            update_request_count()
-            if entry.target.id == role.id:
-                embed = discord.Embed(title=f"Role deleted: {role.name}", color=discord.Color.red())
-                embed.add_field(name="Deleted by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="Role ID", value=role.id)
-                asyncio.create_task(log_event(role.guild.id, 'guild_role_delete', embed))
-                break
+    route = get_event_route(role.guild.id, 'guild_role_delete')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(role.guild, discord.AuditLogAction.role_delete, role.id)
+        if entry:
+            embed = discord.Embed(title=f"Role deleted: {role.name}", color=discord.Color.red())
+            embed.add_field(name="Deleted by", value=format_audit_log_user(entry))
+            embed.add_field(name="Role ID", value=role.id)
+            await queue_event(role.guild.id, 'guild_role_delete', embed)
 
 @bot.event
 async def on_guild_role_update(before, after):
-    if not is_event_enabled(before.guild.id, 'guild_role_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(before.guild.id)
-    if log_channel:
+    route = get_event_route(before.guild.id, 'guild_role_update')
+    if route is not None:
         if before.name != after.name:
             embed = discord.Embed(title="Role name updated", color=discord.Color.blue())
             embed.add_field(name="Role", value=after.mention)
             embed.add_field(name="Before", value=before.name, inline=False)
             embed.add_field(name="After", value=after.name, inline=False)
-            asyncio.create_task(log_event(before.guild.id, 'guild_role_update', embed))
+            await queue_event(before.guild.id, 'guild_role_update', embed)
 
         if before.permissions != after.permissions:
             embed = discord.Embed(title="Role permissions updated.", color=discord.Color.blue())
@@ -261,338 +380,415 @@ async def on_guild_role_update(before, after):
             if added_permissions:
                 embed.add_field(name="Added Permissions", value=", ".join(added_permissions), inline=False)
             
-            asyncio.create_task(log_event(before.guild.id, 'guild_role_update', embed))
+            await queue_event(before.guild.id, 'guild_role_update', embed)
 
         if before.color != after.color:
             embed = discord.Embed(title="Role colour updated", color=discord.Color.blue())
             embed.add_field(name="Role", value=after.mention)
             embed.add_field(name="Before", value=str(before.color), inline=False)
             embed.add_field(name="After", value=str(after.color), inline=False)
-            asyncio.create_task(log_event(before.guild.id, 'guild_role_update', embed))
+            await queue_event(before.guild.id, 'guild_role_update', embed)
 
 @bot.event
 async def on_guild_update(before, after):
-    if not is_event_enabled(after.id, 'guild_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(after.id)
-    if log_channel:
+    route = get_event_route(after.id, 'guild_update')
+    if route is not None:
         if before.name != after.name:
             embed = discord.Embed(title="Server name updated", color=discord.Color.blue())
             embed.add_field(name="Before", value=before.name, inline=False)
             embed.add_field(name="After", value=after.name, inline=False)
-            asyncio.create_task(log_event(after.id, 'guild_update', embed))
+            await queue_event(after.id, 'guild_update', embed)
 
         if before.icon != after.icon:
             embed = discord.Embed(title="Server icon updated", color=discord.Color.blue())
             embed.set_thumbnail(url=after.icon.url)
-            asyncio.create_task(log_event(after.id, 'guild_update', embed))
+            await queue_event(after.id, 'guild_update', embed)
 
         if before.region != after.region:
             embed = discord.Embed(title="Server region updated", color=discord.Color.blue())
             embed.add_field(name="Before", value=str(before.region), inline=False)
             embed.add_field(name="After", value=str(after.region), inline=False)
-            asyncio.create_task(log_event(after.id, 'guild_update', embed))
+            await queue_event(after.id, 'guild_update', embed)
 
         if before.premium_tier != after.premium_tier:
             embed = discord.Embed(title="Server boost level updated.", color=discord.Color.purple())
             embed.add_field(name="Before", value=f"Level {before.premium_tier}")
             embed.add_field(name="After", value=f"Level {after.premium_tier}")
-            asyncio.create_task(log_event(after.id, 'guild_update', embed))
+            await queue_event(after.id, 'guild_update', embed)
 
 @bot.event
 async def on_invite_create(invite):
-    if not is_event_enabled(invite.guild.id, 'invite_create'):
-        return
-
-    log_channel = LOG_CHANNELS.get(invite.guild.id)
-    if log_channel:
+    route = get_event_route(invite.guild.id, 'invite_create')
+    if route is not None:
         embed = discord.Embed(title="Invite created", color=discord.Color.green())
         embed.add_field(name="Code", value=invite.code)
         embed.add_field(name="Inviter", value=f"{invite.inviter.mention} ({invite.inviter.id})")
         embed.add_field(name="Channel", value=invite.channel.mention)
         embed.add_field(name="Max Uses", value=invite.max_uses)
         embed.add_field(name="Temporary", value=invite.temporary)
-        asyncio.create_task(log_event(invite.guild.id, 'invite_create', embed))
+        await queue_event(invite.guild.id, 'invite_create', embed)
 
 @bot.event
 async def on_invite_delete(invite):
-    if not is_event_enabled(invite.guild.id, 'invite_delete'):
-        return
-
-    log_channel = LOG_CHANNELS.get(invite.guild.id)
-    if log_channel:
+    route = get_event_route(invite.guild.id, 'invite_delete')
+    if route is not None:
         embed = discord.Embed(title="Invite deleted", color=discord.Color.red())
         embed.add_field(name="Code", value=invite.code)
         embed.add_field(name="Channel", value=invite.channel.mention)
-        asyncio.create_task(log_event(invite.guild.id, 'invite_delete', embed))
+        await queue_event(invite.guild.id, 'invite_delete', embed)
 
 @bot.event
 async def on_member_join(member):
-    if not is_event_enabled(member.guild.id, 'member_join'):
-        return
-
-    log_channel = LOG_CHANNELS.get(member.guild.id)
-    if log_channel:
+    route = get_event_route(member.guild.id, 'member_join')
+    if route is not None:
         embed = discord.Embed(title=f"{member} joined the server", color=discord.Color.green())
         embed.set_thumbnail(url=member.avatar.url)
         embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-        asyncio.create_task(log_event(member.guild.id, 'member_join', embed))
+        await queue_event(member.guild.id, 'member_join', embed)
 
 @bot.event
 async def on_member_remove(member):
-    if not is_event_enabled(member.guild.id, 'member_remove'):
-        return
-
-    log_channel = LOG_CHANNELS.get(member.guild.id)
-    if log_channel:
+    route = get_event_route(member.guild.id, 'member_remove')
+    if route is not None:
         embed = discord.Embed(title=f"{member} left the server", color=discord.Color.red())
         embed.set_thumbnail(url=member.avatar.url)
         embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-        asyncio.create_task(log_event(member.guild.id, 'member_remove', embed))
+        await queue_event(member.guild.id, 'member_remove', embed)
+
+async def log_message_delete(route, guild, channel_id, author_id, content, avatar_url=None):
+    if route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(guild, discord.AuditLogAction.message_delete, author_id, check=lambda entry: entry.extra.channel.id == channel_id)
+        if entry:
+            if hasattr(entry, 'bulk') and entry.bulk:
+                embed = discord.Embed(title=f"Multiple messages deleted by a moderator in <#{channel_id}>", color=discord.Color.red())
+                embed.add_field(name="Deleted by", value=format_audit_log_user(entry))
+                await queue_event(guild.id, 'message_delete', embed)
+            else:
+                embed = discord.Embed(title=f"Message deleted by a moderator in <#{channel_id}>", color=discord.Color.red())
+                if avatar_url:
+                    embed.set_thumbnail(url=avatar_url)
+                embed.add_field(name="Author", value=f"<@{author_id}> ({author_id})")
+                if hasattr(entry.extra, 'content') and entry.extra.content:
+                    embed.add_field(name="Content", value=entry.extra.content, inline=False)
+                else:
+                    embed.add_field(name="Content", value=content, inline=False)
+                embed.add_field(name="Deleted by", value=format_audit_log_user(entry))
+                await queue_event(guild.id, 'message_delete', embed)
+            return
+
+        embed = discord.Embed(title=f"Message deleted in <#{channel_id}>", color=discord.Color.red())
+        if avatar_url:
+            embed.set_thumbnail(url=avatar_url)
+        embed.add_field(name="Author", value=f"<@{author_id}> ({author_id})")
+        embed.add_field(name="Content", value=content, inline=False)
+        await queue_event(guild.id, 'message_delete', embed)
 
 @bot.event
 async def on_message_delete(message):
-    if not is_event_enabled(message.guild.id, 'message_delete'):
-        return
+    route = get_event_route(message.guild.id, 'message_delete')
+    if route is not None:
+        await log_message_delete(route, message.guild, message.channel.id, message.author.id, message.content, avatar_url=message.author.avatar.url)
 
-    log_channel = LOG_CHANNELS.get(message.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in message.guild.audit_logs(limit=1, action=discord.AuditLogAction.message_delete):
-            update_request_count()
-            if entry.target.id == message.author.id and entry.extra.channel.id == message.channel.id:
-                if hasattr(entry, 'bulk') and entry.bulk:
-                    embed = discord.Embed(title=f"Multiple messages deleted by a moderator in {message.channel.mention}", color=discord.Color.red())
-                    embed.add_field(name="Deleted by", value=f"{entry.user.mention} ({entry.user.id})")
-                    asyncio.create_task(log_event(message.guild.id, 'message_delete', embed))
-                else:
-                    embed = discord.Embed(title=f"Message deleted by a moderator in {message.channel.mention}", color=discord.Color.red())
-                    embed.set_thumbnail(url=message.author.avatar.url)
-                    embed.add_field(name="Author", value=f"{message.author.mention} ({message.author.id})")
-                    if hasattr(entry.extra, 'content') and entry.extra.content:
-                        embed.add_field(name="Content", value=entry.extra.content, inline=False)
-                    else:
-                        embed.add_field(name="Content", value=message.content, inline=False)
-                    embed.add_field(name="Deleted by", value=f"{entry.user.mention} ({entry.user.id})")
-                    asyncio.create_task(log_event(message.guild.id, 'message_delete', embed))
-                return
+@bot.event
+async def on_raw_message_delete(payload):
+    # Messages in discord.py's cache are handled by on_message_delete
+    if payload.cached_message is not None or payload.guild_id is None:
+        return
+    route = get_event_route(payload.guild_id, 'message_delete')
+    if route is None:
+        return
 
-        embed = discord.Embed(title=f"Message deleted in {message.channel.mention}", color=discord.Color.red())
-        embed.set_thumbnail(url=message.author.avatar.url)
-        embed.add_field(name="Author", value=f"{message.author.mention} ({message.author.id})")
-        embed.add_field(name="Content", value=message.content, inline=False)
-        asyncio.create_task(log_event(message.guild.id, 'message_delete', embed))
+    stored_message = await get_message(payload.guild_id, payload.message_id)
+    if stored_message is None:
+        logging.debug(f"on_raw_message_delete: Guild ID: {payload.guild_id}, Message ID: {payload.message_id}, Message not cached")
+        return
+    guild = bot.get_guild(payload.guild_id)
+    if guild:
+        await log_message_delete(route, guild, stored_message.channel_id, stored_message.author_id, stored_message.content)
 
 @bot.event
-async def on_message_edit(before, after):
-    if not is_event_enabled(before.guild.id, 'message_edit'):
+async def on_raw_bulk_message_delete(payload):
+    if payload.guild_id is None:
         return
 
-    log_channel = LOG_CHANNELS.get(before.guild.id)
-    if log_channel:
+    route = get_event_route(payload.guild_id, 'message_delete')
+    if route is not None:
+        # One log entry for the whole purge instead of one per message
+        cached_messages = {message.id: (message.author.id, message.content) for message in payload.cached_messages}
+        uncached_ids = [message_id for message_id in payload.message_ids if message_id not in cached_messages]
+        stored_messages = await get_messages(payload.guild_id, uncached_ids) if uncached_ids else {}
+
+        lines = []
+        missing = 0
+        for message_id in sorted(payload.message_ids):
+            if message_id in cached_messages:
+                author_id, content = cached_messages[message_id]
+            elif message_id in stored_messages:
+                author_id, content = stored_messages[message_id].author_id, stored_messages[message_id].content
+            else:
+                missing += 1
+                continue
+            lines.append(f"<@{author_id}>: {truncate(content or '*No text*', BULK_DELETE_LINE_LENGTH)}")
+        if missing:
+            lines.append(f"*{missing} message(s) not cached*")
+
+        embed = discord.Embed(title=f"{len(payload.message_ids)} messages deleted in <#{payload.channel_id}>", description="\n".join(lines), color=discord.Color.red())
+        if route.can_view_audit_log():
+            entry = await wait_for_audit_log_entry(route.log_channel.guild, discord.AuditLogAction.message_bulk_delete, payload.channel_id)
+            if entry:
+                embed.add_field(name="Deleted by", value=format_audit_log_user(entry))
+        await queue_event(payload.guild_id, 'message_delete', embed)
+
+@bot.event
+async def on_message_edit(before, after):
+    route = get_event_route(before.guild.id, 'message_edit')
+    if route is not None:
         embed = discord.Embed(title=f"Message edited in {before.channel.mention}", color=discord.Color.blue())
         embed.set_thumbnail(url=before.author.avatar.url)
         embed.add_field(name="Author", value=f"{before.author.mention} ({before.author.id})")
         embed.add_field(name="Before", value=before.content, inline=False)
         embed.add_field(name="After", value=after.content, inline=False)
-        asyncio.create_task(log_event(before.guild.id, 'message_edit', embed))
+        await queue_event(before.guild.id, 'message_edit', embed)
 
 @bot.event
-async def on_member_ban(guild, user):
-    if not is_event_enabled(guild.id, 'member_ban'):
+async def on_raw_message_edit(payload):
+    # Embed unfurls also arrive as edits, only content changes matter here
+    if payload.guild_id is None or 'content' not in payload.data or payload.data.get('webhook_id'):
         return
 
-    log_channel = LOG_CHANNELS.get(guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.ban):
-            update_request_count()
-            if entry.target == user:
-                embed = discord.Embed(title=f"{user} was banned from the server", color=discord.Color.red())
-                embed.set_thumbnail(url=user.avatar.url)
-                embed.add_field(name="User", value=f"{user.mention} ({user.id})")
-                embed.add_field(name="Banned by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
-                asyncio.create_task(log_event(guild.id, 'member_ban', embed))
-                return
+    # Messages in discord.py's cache are handled by on_message_edit
+    if payload.cached_message is None and get_event_route(payload.guild_id, 'message_edit') is not None:
+        stored_message = await get_message(payload.guild_id, payload.message_id)
+        if stored_message is not None and stored_message.content != payload.data['content']:
+            embed = discord.Embed(title=f"Message edited in <#{payload.channel_id}>", color=discord.Color.blue())
+            embed.add_field(name="Author", value=f"<@{stored_message.author_id}> ({stored_message.author_id})")
+            embed.add_field(name="Before", value=stored_message.content, inline=False)
+            embed.add_field(name="After", value=payload.data['content'], inline=False)
+            await queue_event(payload.guild_id, 'message_edit', embed)
+
+    update_message_content(payload.guild_id, payload.message_id, payload.data['content'])
 
 @bot.event
-async def on_member_kick(guild, user):
-    if not is_event_enabled(guild.id, 'member_kick'):
-        return
+async def on_member_ban(guild, user):
+    route = get_event_route(guild.id, 'member_ban')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(guild, discord.AuditLogAction.ban, user.id)
+        if entry:
+            embed = discord.Embed(title=f"{user} was banned from the server", color=discord.Color.red())
+            embed.set_thumbnail(url=user.avatar.url)
+            embed.add_field(name="User", value=f"{user.mention} ({user.id})")
+            embed.add_field(name="Banned by", value=format_audit_log_user(entry))
+            embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
+            await queue_event(guild.id, 'member_ban', embed)
 
-    log_channel = LOG_CHANNELS.get(guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.kick):
-            update_request_count()
-            if entry.target == user:
-                embed = discord.Embed(title=f"{user} was kicked from the server", color=discord.Color.red())
-                embed.set_thumbnail(url=user.avatar.url)
-                embed.add_field(name="User", value=f"{user.mention} ({user.id})")
-                embed.add_field(name="Kicked by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
-                asyncio.create_task(log_event(guild.id, 'member_kick', embed))
-                return
+@bot.event
+async def on_member_kick(guild, user):
+    route = get_event_route(guild.id, 'member_kick')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(guild, discord.AuditLogAction.kick, user.id)
+        if entry:
+            embed = discord.Embed(title=f"{user} was kicked from the server", color=discord.Color.red())
+            embed.set_thumbnail(url=user.avatar.url)
+            embed.add_field(name="User", value=f"{user.mention} ({user.id})")
+            embed.add_field(name="Kicked by", value=format_audit_log_user(entry))
+            embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
+            await queue_event(guild.id, 'member_kick', embed)
 
 @bot.event
 async def on_member_remove_timeout(member):
-    if not is_event_enabled(member.guild.id, 'member_remove_timeout'):
-        return
-
-    log_channel = LOG_CHANNELS.get(member.guild.id)
-    if log_channel:
+    route = get_event_route(member.guild.id, 'member_remove_timeout')
+    if route is not None:
         embed = discord.Embed(title=f"{member}'s timeout was removed", color=discord.Color.green())
         embed.set_thumbnail(url=member.avatar.url)
         embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-        asyncio.create_task(log_event(member.guild.id, 'member_remove_timeout', embed))
+        await queue_event(member.guild.id, 'member_remove_timeout', embed)
 
 @bot.event
 async def on_member_timeout(member, until):
-    if not is_event_enabled(member.guild.id, 'member_timeout'):
-        return
-
-    log_channel = LOG_CHANNELS.get(member.guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in member.guild.audit_logs(limit=1, action=discord.AuditLogAction.member_update):
-            update_request_count()
-            if entry.target == member and entry.before.communication_disabled_until is None and entry.after.communication_disabled_until is not None:
-                embed = discord.Embed(title=f"{member} was timed out until {until}", color=discord.Color.red())
-                embed.set_thumbnail(url=member.avatar.url)
-                embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-                embed.add_field(name="Timed out by", value=f"{entry.user.mention} ({entry.user.id})")
-                embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
-                asyncio.create_task(log_event(member.guild.id, 'member_remove_timeout', embed))
-                return
+    route = get_event_route(member.guild.id, 'member_timeout')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(member.guild, discord.AuditLogAction.member_update, member.id, check=lambda entry: getattr(entry.before, 'communication_disabled_until', None) is None and getattr(entry.after, 'communication_disabled_until', None) is not None)
+        if entry:
+            embed = discord.Embed(title=f"{member} was timed out until {until}", color=discord.Color.red())
+            embed.set_thumbnail(url=member.avatar.url)
+            embed.add_field(name="User", value=f"{member.mention} ({member.id})")
+            embed.add_field(name="Timed out by", value=format_audit_log_user(entry))
+            embed.add_field(name="Reason", value=entry.reason or "No reason provided", inline=False)
+            await queue_event(member.guild.id, 'member_remove_timeout', embed)
 
 @bot.event
 async def on_member_unban(guild, user):
-    if not is_event_enabled(guild.id, 'member_unban'):
-        return
-
-    log_channel = LOG_CHANNELS.get(guild.id)
-    if log_channel and has_permission(log_channel, log_channel.guild.me, 'view_audit_log'):
-        async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.unban):
-            update_request_count()
-            if entry.target == user:
-                embed = discord.Embed(title=f"{user} was unbanned from the server", color=discord.Color.green())
-                embed.set_thumbnail(url=user.avatar.url)
-                embed.add_field(name="User", value=f"{user.mention} ({user.id})")
-                embed.add_field(name="Unbanned by", value=f"{entry.user.mention} ({entry.user.id})")
-                asyncio.create_task(log_event(guild.id, 'member_unban', embed))
-                return
+    route = get_event_route(guild.id, 'member_unban')
+    if route is not None and route.can_view_audit_log():
+        entry = await wait_for_audit_log_entry(guild, discord.AuditLogAction.unban, user.id)
+        if entry:
+            embed = discord.Embed(title=f"{user} was unbanned from the server", color=discord.Color.green())
+            embed.set_thumbnail(url=user.avatar.url)
+            embed.add_field(name="User", value=f"{user.mention} ({user.id})")
+            embed.add_field(name="Unbanned by", value=format_audit_log_user(entry))
+            await queue_event(guild.id, 'member_unban', embed)
+
+def summarize_member_updates(updates):
+    # Only the net change over the window is logged, a role added and removed again leaves nothing
+    before, after = updates[0][0], updates[-1][1]
+    entries = []
+    if before.roles != after.roles:
+        embed = discord.Embed(title=f"{after}'s roles were updated", color=discord.Color.blue())
+        embed.set_thumbnail(url=after.avatar.url)
+        embed.add_field(name="User", value=f"{after.mention} ({after.id})")
+        embed.add_field(name="Before", value=", ".join([role.name for role in before.roles]), inline=False)
+        embed.add_field(name="After", value=", ".join([role.name for role in after.roles]), inline=False)
+        entries.append(('member_update', embed))
+
+    if before.nick != after.nick:
+        embed = discord.Embed(title=f"{before}'s nickname was updated", color=discord.Color.blue())
+        embed.set_thumbnail(url=before.avatar.url)
+        embed.add_field(name="User", value=f"{before.mention} ({before.id})")
+        embed.add_field(name="Before", value=before.nick, inline=False)
+        embed.add_field(name="After", value=after.nick, inline=False)
+        entries.append(('member_update', embed))
+
+    if len(updates) > 1:
+        for _, embed in entries:
+            embed.set_footer(text=f"Net change of {len(updates)} updates")
+    return entries
 
 @bot.event
 async def on_member_update(before, after):
-    if not is_event_enabled(after.id, 'member_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(before.guild.id)
-    if log_channel:
-        if before.roles != after.roles:
-            embed = discord.Embed(title=f"{after}'s roles were updated", color=discord.Color.blue())
-            embed.set_thumbnail(url=after.avatar.url)
-            embed.add_field(name="User", value=f"{after.mention} ({after.id})")
-            embed.add_field(name="Before", value=", ".join([role.name for role in before.roles]), inline=False)
-            embed.add_field(name="After", value=", ".join([role.name for role in after.roles]), inline=False)
-            asyncio.create_task(log_event(before.guild.id, 'member_update', embed))
-
-        if before.nick != after.nick:
-            embed = discord.Embed(title=f"{before}'s nickname was updated", color=discord.Color.blue())
-            embed.set_thumbnail(url=before.avatar.url)
-            embed.add_field(name="User", value=f"{before.mention} ({before.id})")
-            embed.add_field(name="Before", value=before.nick, inline=False)
-            embed.add_field(name="After", value=after.nick, inline=False)
-            asyncio.create_task(log_event(before.guild.id, 'member_update', embed))
+    route = get_event_route(after.guild.id, 'member_update')
+    if route is not None:
+        if before.roles != after.roles or before.nick != after.nick:
+            await coalesce_event(after.guild.id, 'member_update', after.id, (before, after), summarize_member_updates)
 
         if before.premium_since != after.premium_since:
             if after.premium_since is not None:
                 embed = discord.Embed(title=f"{before} boosted the server", color=discord.Color.purple())
                 embed.set_thumbnail(url=before.avatar.url)
                 embed.add_field(name="User", value=f"{before.mention} ({before.id})")
-                asyncio.create_task(log_event(before.guild.id, 'member_update', embed))
+                await queue_event(before.guild.id, 'member_update', embed)
             else:
                 embed = discord.Embed(title=f"{before} unboosted the server", color=discord.Color.purple())
                 embed.set_thumbnail(url=before.avatar.url)
                 embed.add_field(name="User", value=f"{before.mention} ({before.id})")
-                asyncio.create_task(log_event(before.guild.id, 'member_update', embed))
+                await queue_event(before.guild.id, 'member_update', embed)
+
+def reaction_embed(user, emoji, message, change):
+    if change > 0:
+        embed = discord.Embed(title=f"{user} reacted with {emoji} to a message", color=discord.Color.blue())
+    else:
+        embed = discord.Embed(title=f"{user} removed their {emoji} reaction from a message", color=discord.Color.blue())
+    embed.set_thumbnail(url=user.avatar.url)
+    embed.add_field(name="User", value=f"{user.mention} ({user.id})")
+    embed.add_field(name="Message", value=f"[Jump to Message]({message.jump_url})", inline=False)
+    return embed
+
+def summarize_reactions(reactions):
+    if len(reactions) == 1:
+        user, emoji, message, change = reactions[0]
+        return [('reaction_add' if change > 0 else 'reaction_remove', reaction_embed(user, emoji, message, change))]
+
+    # A reaction added and removed again by the same user within the window cancels out
+    net_changes = {}
+    for user, emoji, message, change in reactions:
+        key = (user.id, str(emoji))
+        if key in net_changes:
+            net_changes[key][2] += change
+        else:
+            net_changes[key] = [user, emoji, change]
+    message = reactions[0][2]
+
+    entries = []
+    for event_name, title, sign in (('reaction_add', "reaction(s) added to a message", 1), ('reaction_remove', "reaction(s) removed from a message", -1)):
+        changed = [(user, emoji) for user, emoji, change in net_changes.values() if change * sign > 0]
+        if changed:
+            embed = discord.Embed(title=f"{len(changed)} {title}", description="\n".join(f"{user.mention}: {emoji}" for user, emoji in changed), color=discord.Color.blue())
+            embed.add_field(name="Message", value=f"[Jump to Message]({message.jump_url})", inline=False)
+            entries.append((event_name, embed))
+    return entries
 
 @bot.event
 async def on_reaction_add(reaction, user):
-    if not is_event_enabled(reaction.message.guild.id, 'reaction_add'):
-      return
-
-    log_channel = LOG_CHANNELS.get(reaction.message.guild.id)
-    if log_channel:
-        embed = discord.Embed(title=f"{user} reacted with {reaction.emoji} to a message", color=discord.Color.blue())
-        embed.set_thumbnail(url=user.avatar.url)
-        embed.add_field(name="User", value=f"{user.mention} ({user.id})")
-        embed.add_field(name="Message", value=f"[Jump to Message]({reaction.message.jump_url})", inline=False)
-        asyncio.create_task(log_event(reaction.message.guild.id, 'reaction_add', embed))
+    route = get_event_route(reaction.message.guild.id, 'reaction_add')
+    if route is not None:
+        await coalesce_event(reaction.message.guild.id, 'reaction', reaction.message.id, (user, reaction.emoji, reaction.message, 1), summarize_reactions)
 
 @bot.event
 async def on_reaction_remove(reaction, user):
-    if not is_event_enabled(reaction.message.guild.id, 'reaction_remove'):
-        return
-
-    log_channel = LOG_CHANNELS.get(reaction.message.guild.id)
-    if log_channel:
-        embed = discord.Embed(title=f"{user} removed their {reaction.emoji} reaction from a message", color=discord.Color.blue())
-        embed.set_thumbnail(url=user.avatar.url)
-        embed.add_field(name="User", value=f"{user.mention} ({user.id})")
-        embed.add_field(name="Message", value=f"[Jump to Message]({reaction.message.jump_url})", inline=False)
-        asyncio.create_task(log_event(reaction.message.guild.id, 'reaction_remove', embed))
+    route = get_event_route(reaction.message.guild.id, 'reaction_remove')
+    if route is not None:
+        await coalesce_event(reaction.message.guild.id, 'reaction', reaction.message.id, (user, reaction.emoji, reaction.message, -1), summarize_reactions)
+
+def voice_change_embed(member, before_channel, after_channel):
+    # Check if the member joined or left a voice channel
+    if before_channel is None:
+        embed = discord.Embed(title=f"{member} joined voice channel {after_channel.mention}", color=discord.Color.green())
+        embed.set_thumbnail(url=member.avatar.url)
+        embed.add_field(name="User", value=f"{member.mention} ({member.id})")
+        embed.add_field(name="Channel", value=f"{after_channel.mention} ({after_channel.id})")
+    elif after_channel is None:
+        embed = discord.Embed(title=f"{member} left voice channel {before_channel.mention}", color=discord.Color.red())
+        embed.set_thumbnail(url=member.avatar.url)
+        embed.add_field(name="User", value=f"{member.mention} ({member.id})")
+        embed.add_field(name="Channel", value=f"{before_channel.mention} ({before_channel.id})")
+    # Otherwise the member moved between voice channels
+    else:
+        embed = discord.Embed(title=f"{member} moved from {before_channel.mention} to {after_channel.mention}", color=discord.Color.blue())
+        embed.set_thumbnail(url=member.avatar.url)
+        embed.add_field(name="User", value=f"{member.mention} ({member.id})")
+        embed.add_field(name="Before", value=f"{before_channel.mention} ({before_channel.id})")
+        embed.add_field(name="After", value=f"{after_channel.mention} ({after_channel.id})")
+    return embed
+
+def summarize_voice_changes(changes):
+    member = changes[0][0]
+    if len(changes) == 1:
+        return [('voice_state_update', voice_change_embed(*changes[0]))]
+
+    joins = sum(1 for _, before_channel, _ in changes if before_channel is None)
+    leaves = sum(1 for _, _, after_channel in changes if after_channel is None)
+    channels = []
+    for _, before_channel, after_channel in changes:
+        for channel in (before_channel, after_channel):
+            if channel is not None and channel not in channels:
+                channels.append(channel)
+    final_channel = changes[-1][2]
+
+    embed = discord.Embed(title=f"{member} changed voice channels {len(changes)} times in {COALESCE_WINDOW}s", color=discord.Color.blue())
+    embed.set_thumbnail(url=member.avatar.url)
+    embed.add_field(name="User", value=f"{member.mention} ({member.id})")
+    embed.add_field(name="Joined", value=joins)
+    embed.add_field(name="Left", value=leaves)
+    embed.add_field(name="Moved", value=len(changes) - joins - leaves)
+    embed.add_field(name="Channels", value=", ".join(channel.mention for channel in channels), inline=False)
+    embed.add_field(name="Now in", value=f"{final_channel.mention} ({final_channel.id})" if final_channel else "None", inline=False)
+    return [('voice_state_update', embed)]
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    if not is_event_enabled(member.guild.id, 'voice_state_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(member.guild.id)
-    if log_channel:
-        # Check if the member joined or left a voice channel
-        if before.channel is None and after.channel is not None:
-            embed = discord.Embed(title=f"{member} joined voice channel {after.channel.mention}", color=discord.Color.green())
-            embed.set_thumbnail(url=member.avatar.url)
-            embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-            embed.add_field(name="Channel", value=f"{after.channel.mention} ({after.channel.id})")
-            asyncio.create_task(log_event(member.guild.id, 'voice_state_update', embed))
-        elif before.channel is not None and after.channel is None:
-            embed = discord.Embed(title=f"{member} left voice channel {before.channel.mention}", color=discord.Color.red())
-            embed.set_thumbnail(url=member.avatar.url)
-            embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-            embed.add_field(name="Channel", value=f"{before.channel.mention} ({before.channel.id})")
-            asyncio.create_task(log_event(member.guild.id, 'voice_state_update', embed))
-        # Check if the member moved between voice channels
-        elif before.channel != after.channel:
-            embed = discord.Embed(title=f"{member} moved from {before.channel.mention} to {after.channel.mention}", color=discord.Color.blue())
-            embed.set_thumbnail(url=member.avatar.url)
-            embed.add_field(name="User", value=f"{member.mention} ({member.id})")
-            embed.add_field(name="Before", value=f"{before.channel.mention} ({before.channel.id})")
-            embed.add_field(name="After", value=f"{after.channel.mention} ({after.channel.id})")
-            asyncio.create_task(log_event(member.guild.id, 'voice_state_update', embed))
+    route = get_event_route(member.guild.id, 'voice_state_update')
+    # Mute and deafen changes don't move the member and aren't logged
+    if route is not None and before.channel != after.channel:
+        await coalesce_event(member.guild.id, 'voice_state_update', member.id, (member, before.channel, after.channel), summarize_voice_changes)
 
 @bot.event
 async def on_webhooks_update(channel):
-    if not is_event_enabled(channel.guild.id, 'webhooks_update'):
-        return
-
-    log_channel = LOG_CHANNELS.get(channel.guild.id)
-    if log_channel:
-        webhook_url = LOG_WEBHOOKS.get(channel.guild.id)
-        if webhook_url:
+    route = get_event_route(channel.guild.id, 'webhooks_update')
+    if route is not None:
+        if route.webhook:
             try:
                 async with aiohttp.ClientSession() as session:
-                    webhook = discord.Webhook.from_url(webhook_url, session=session)
+                    webhook = discord.Webhook.from_url(route.webhook.webhook_url, session=session)
                     await webhook.fetch()
+                    update_request_count('rest', channel.guild.id)
             except discord.NotFound:
-                # If the webhook is invalid, delete it from the dictionary
-                del LOG_WEBHOOKS[channel.guild.id]
-                webhook = None
+                # The webhook was deleted, put a new one in its place
+                webhook = await heal_webhook(channel.guild.id, route.webhook)
 
             if webhook is not None:
                 # If a valid webhook exists, log the event
                 embed = discord.Embed(title="Webhooks updated", color=discord.Color.blue())
                 embed.add_field(name="Channel", value=channel.mention)
-                asyncio.create_task(log_event(channel.guild.id, 'webhooks_update', embed))
+                await queue_event(channel.guild.id, 'webhooks_update', embed)
 
 @bot.command()
 async def loghelp(ctx):
@@ -605,7 +801,7 @@ async def loghelp(ctx):
 @bot.command()
 @commands.has_permissions(manage_guild=True)
 async def getlogconfig(ctx):
-    config = get_config(ctx.guild.id)
+    config = await get_config(ctx.guild.id)
     if config:
         log_channel_name, log_events, webhook_url = config
         log_channel = discord.utils.get(ctx.guild.text_channels, name=log_channel_name)
@@ -633,33 +829,17 @@ async def setlogconfig(ctx, log_channel: discord.TextChannel = None, *, log_even
 
     # If only the channel is provided, update the channel
     if log_channel and not log_events:
-        # Check if a Logging Webhook exists in the old channel
-        old_log_channel = LOG_CHANNELS.get(ctx.guild.id)
+        # Remove the Logging Webhooks from the old channel
+        old_log_channel = get_guild_route(ctx.guild.id).log_channel
         if old_log_channel:
-            webhook = None
-            for hook in await old_log_channel.webhooks():
-                if hook.name == "LoggerHead":
-                    webhook = hook
-                    break
-            if webhook:
-                await webhook.delete()
-
-        # Create a new Logging Webhook in the new channel
-        webhook = None
-        for hook in await log_channel.webhooks():
-            if hook.name == "LoggerHead":
-                webhook = hook
-                break
-        if webhook is None:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(bot.user.avatar.url) as response:
-                    avatar_bytes = await response.read()
-            webhook = await log_channel.create_webhook(name="LoggerHead", avatar=avatar_bytes)
-
-        set_config(ctx.guild.id, log_channel.name, None)  # Update only the channel name
-        LOG_CHANNELS[ctx.guild.id] = log_channel
-        LOG_WEBHOOKS[ctx.guild.id] = webhook.url
-        set_webhook_url(ctx.guild.id, webhook.url)  # Update the webhook URL in the database
+            await delete_log_webhooks(old_log_channel)
+
+        # Create a new pool of Logging Webhooks in the new channel
+        webhooks = await create_log_webhooks(log_channel)
+
+        await set_config(ctx.guild.id, log_channel.name, None)  # Update only the channel name
+        set_log_channel(ctx.guild.id, log_channel)
+        await save_log_webhooks(ctx.guild.id, [webhook.url for webhook in webhooks])
         await ctx.send(f"Logging channel updated to: {log_channel.mention}")
         return
 
@@ -678,8 +858,8 @@ async def setlogconfig(ctx, log_channel: discord.TextChannel = None, *, log_even
             log_events = ','.join(log_events_list)  # Rejoin the valid events
 
         # Update only the log events
-        LOG_EVENT_SETTINGS[ctx.guild.id] = set(log_events_list)
-        set_config(ctx.guild.id, None, log_events)
+        set_log_events(ctx.guild.id, log_events.split(',') if log_events else [])
+        await set_config(ctx.guild.id, None, log_events)
         await ctx.send(f"Logging events updated.")
         return
 
@@ -697,35 +877,18 @@ async def setlogconfig(ctx, log_channel: discord.TextChannel = None, *, log_even
                 return
             log_events = ','.join(log_events_list)  # Rejoin the valid events
     
-        # Check if a Logging Webhook exists in the old channel
-        old_log_channel = LOG_CHANNELS.get(ctx.guild.id)
+        # Remove the Logging Webhooks from the old channel
+        old_log_channel = get_guild_route(ctx.guild.id).log_channel
         if old_log_channel:
-            webhook = None
-            for hook in await old_log_channel.webhooks():
-                if hook.name == "LoggerHead":
-                    webhook = hook
-                    break
-            if webhook:
-                await webhook.delete()
+            await delete_log_webhooks(old_log_channel)
     
-        # Create a new Logging Webhook in the new channel
-        webhook = None
-        for hook in await log_channel.webhooks():
-            if hook.name == "LoggerHead":
-                webhook = hook
-                break
-        if webhook is None:
-            avatar_url = bot.user.avatar.url
-            async with aiohttp.ClientSession() as session:
-                async with session.get(bot.user.avatar.url) as response:
-                    avatar_bytes = await response.read()
-            webhook = await log_channel.create_webhook(name="LoggerHead", avatar=avatar_bytes)
+        # Create a new pool of Logging Webhooks in the new channel
+        webhooks = await create_log_webhooks(log_channel)
     
-        LOG_EVENT_SETTINGS[ctx.guild.id] = set(log_events_list)
-        set_config(ctx.guild.id, log_channel.name, log_events)
-        LOG_CHANNELS[ctx.guild.id] = log_channel
-        LOG_WEBHOOKS[ctx.guild.id] = webhook.url
-        set_webhook_url(ctx.guild.id, webhook.url)  # Update the webhook URL in the database
+        set_log_events(ctx.guild.id, log_events.split(',') if log_events else [])
+        await set_config(ctx.guild.id, log_channel.name, log_events)
+        set_log_channel(ctx.guild.id, log_channel)
+        await save_log_webhooks(ctx.guild.id, [webhook.url for webhook in webhooks])
         await ctx.send(f"Configuration updated.")
 
 @setlogconfig.error
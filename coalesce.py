@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from config import COALESCE_WINDOW
+from metrics import increment
+from utils import queue_event
+
+COALESCED_EVENTS = {}  # (guild_id, kind, key) -> events held until their window closes
+FLUSH_TASKS = set()  # Running flushes, the event loop only keeps weak references to tasks
+
+async def coalesce_event(guild_id, kind, key, event, summarize):
+    # Events of the same kind and key that arrive within COALESCE_WINDOW seconds of the first are
+    # handed to summarize together, which returns the (event_name, embed) pairs to log for them
+    if not COALESCE_WINDOW:
+        for event_name, embed in summarize([event]):
+            await queue_event(guild_id, event_name, embed)
+        return
+
+    group_key = (guild_id, kind, key)
+    events = COALESCED_EVENTS.get(group_key)
+    if events is None:
+        events = COALESCED_EVENTS[group_key] = []
+        asyncio.get_running_loop().call_later(COALESCE_WINDOW, start_flush, group_key, summarize)
+    events.append(event)
+
+def start_flush(group_key, summarize):
+    task = asyncio.create_task(flush_coalesced(group_key, summarize))
+    FLUSH_TASKS.add(task)
+    task.add_done_callback(FLUSH_TASKS.discard)
+
+async def flush_coalesced(group_key, summarize):
+    events = COALESCED_EVENTS.pop(group_key, None)
+    if not events:
+        return
+    guild_id, kind, _ = group_key
+    try:
+        entries = summarize(events)
+    except Exception as e:
+        logging.error(f"Error summarizing {len(events)} {kind} events for guild {guild_id}: {str(e)}")
+        return
+    if len(events) > len(entries):
+        increment('events_coalesced_total', len(events) - len(entries), kind=kind)
+    for event_name, embed in entries:
+        await queue_event(guild_id, event_name, embed)
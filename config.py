@@ -1,35 +1,52 @@
-import psycopg2
-from psycopg2 import OperationalError
+import asyncio
+import asyncpg
 import time
+from contextlib import asynccontextmanager
 import logging
 import yaml
+from metrics import observe
 
-LOG_EVENTS = [
-    'guild_channel_create',
-    'guild_channel_delete',
-    'guild_channel_update',
-    'guild_emojis_update',
-    'guild_role_create',
-    'guild_role_delete',
-    'guild_role_update',
-    'guild_update',
-    'invite_create',
-    'invite_delete',
-    'member_ban',
-    'member_join',
-    'member_kick',
-    'member_remove',
-    'member_remove_timeout',
-    'member_timeout',
-    'member_unban',
-    'member_update',
-    'message_delete',
-    'message_edit',
-    'reaction_add',
-    'reaction_remove',
-    'voice_state_update',
-    'webhooks_update'
-]
+# Priority classes for delivering log messages, lower is sent first
+PRIORITY_HIGH = 0  # Moderation and permission changes
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # High volume, low stakes activity
+
+# Every event that can be logged and its priority class
+LOG_EVENTS = {
+    'guild_channel_create': PRIORITY_NORMAL,
+    'guild_channel_delete': PRIORITY_HIGH,
+    'guild_channel_update': PRIORITY_HIGH,
+    'guild_emojis_update': PRIORITY_NORMAL,
+    'guild_role_create': PRIORITY_HIGH,
+    'guild_role_delete': PRIORITY_HIGH,
+    'guild_role_update': PRIORITY_HIGH,
+    'guild_update': PRIORITY_HIGH,
+    'invite_create': PRIORITY_NORMAL,
+    'invite_delete': PRIORITY_NORMAL,
+    'member_ban': PRIORITY_HIGH,
+    'member_join': PRIORITY_NORMAL,
+    'member_kick': PRIORITY_HIGH,
+    'member_remove': PRIORITY_NORMAL,
+    'member_remove_timeout': PRIORITY_HIGH,
+    'member_timeout': PRIORITY_HIGH,
+    'member_unban': PRIORITY_HIGH,
+    'member_update': PRIORITY_NORMAL,
+    'message_delete': PRIORITY_NORMAL,
+    'message_edit': PRIORITY_NORMAL,
+    'reaction_add': PRIORITY_LOW,
+    'reaction_remove': PRIORITY_LOW,
+    'voice_state_update': PRIORITY_LOW,
+    'webhooks_update': PRIORITY_HIGH
+}
+
+# Each event gets one bit, so a server's enabled events fit in a single integer
+EVENT_BITS = {event_name: 1 << index for index, event_name in enumerate(LOG_EVENTS)}
+
+def events_to_mask(events):
+    mask = 0
+    for event_name in events:
+        mask |= EVENT_BITS.get(event_name, 0)  # Events that no longer exist are ignored
+    return mask
 
 def load_config():
     with open('config.yaml', 'r') as file:
@@ -43,99 +60,224 @@ DB_HOST = config['db_host']
 DB_USER = config['db_user']
 DB_PASSWORD = config['db_password']
 DB_NAME = config['db_name']
+DB_POOL_MIN_SIZE = config.get('db_pool_min_size', 1)  # Connections the pool keeps open
+DB_POOL_MAX_SIZE = config.get('db_pool_max_size', 10)  # Most connections the pool will open
+DB_CONNECT_RETRIES = 3  # Retries after the first failed attempt to connect
+DB_MAX_RETRY_DELAY = 30  # Seconds, the retry delay doubles up to this
+DB_HEALTH_CHECK_INTERVAL = 30  # Seconds between database health checks
+DB_HEALTH_CHECK_TIMEOUT = 5  # Seconds a health check query may take before the pool is recycled
+CONFIG_CHANGE_CHANNEL = 'config_changed'  # Postgres NOTIFY channel carrying the ID of a server whose configuration changed
+SCHEMA_LOCK_ID = 0x4c6f6748  # Advisory lock key held while creating tables, shared by every bot process
+CONFIG_LISTEN_RETRY_DELAY = 5  # Seconds before reconnecting a lost config change listener
+WEBHOOK_CONNECTION_LIMIT = config.get('webhook_connection_limit', 100)  # Maximum simultaneous webhook connections
+WEBHOOK_CONNECTION_LIMIT_PER_HOST = config.get('webhook_connection_limit_per_host', 0)  # 0 means no per-host limit
+METRICS_HOST = config.get('metrics_host', '127.0.0.1')
+METRICS_PORT = config.get('metrics_port')  # Serve Prometheus metrics on this port, disabled when not set
+MESSAGE_RETENTION = config.get('message_retention', 1000)  # Messages kept in the database for each server
+MESSAGE_CACHE_BUDGET = config.get('message_cache_budget', 256 * 1024 * 1024)  # Bytes of messages kept in memory in total
+MESSAGE_CACHE_GUILD_BUDGET = config.get('message_cache_guild_budget', 4 * 1024 * 1024)  # Bytes of messages kept in memory per server
+MESSAGE_CACHE_TTL = config.get('message_cache_ttl', 24 * 60 * 60)  # Seconds an unused message stays in memory
+DISCORD_MAX_MESSAGES = config.get('discord_max_messages', 1000)  # Size of discord.py's own message cache
+COALESCE_WINDOW = config.get('coalesce_window', 10)  # Seconds voice, reaction and member updates are merged over, 0 logs each one
+OUTBOX_PATH = config.get('outbox_path', 'outbox.db')  # SQLite file queued events are kept in until delivered, empty to disable
+OUTBOX_MAX_BYTES = config.get('outbox_max_bytes', 256 * 1024 * 1024)  # Disk budget of the outbox
+SHARD_COUNT = config.get('shard_count')  # Total gateway shards, the bot runs as an AutoShardedBot when set
+# Processes main.py splits the shards across. A process without a shard would run all of them, so
+# there are never more processes than shards
+SHARD_PROCESSES = max(1, min(config.get('shard_processes', 1), SHARD_COUNT or 1))
+SHARD_IDS = None  # Shards run by this process, set by main.py when there is more than one process
+PROCESS_INDEX = 0  # Which of the SHARD_PROCESSES this is, set by main.py
+WEBHOOKS_PER_CHANNEL = max(1, min(config.get('webhooks_per_channel', 1), 10))  # Webhooks each log channel sends through, Discord allows 15 per channel
+RECORD_EVENTS_PATH = config.get('record_events_path')  # Record scrubbed gateway events here for benchmark.py to replay, off when not set
 
-conn = None
-
-def create_config_table():
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS config
-                 (guild_id BIGINT PRIMARY KEY,
-                  log_channel_name TEXT,
-                  log_events TEXT,
-                  webhook_url TEXT)''')
-    conn.commit()
-
-def create_db_connection():
-    global conn
-    if conn is None or conn.closed:
-        try:
-            conn = psycopg2.connect(
-                host=DB_HOST,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                database=DB_NAME
-            )
-            logging.info("Connected to the database.")
-        except OperationalError as e:
-            logging.error(f"Error connecting to the database: {str(e)}")
-            conn = None
-            
-            # Retry the connection
-            max_retries = 3
-            retry_delay = 5  # seconds
-            for retry in range(max_retries):
-                logging.info(f"Retrying connection (attempt {retry + 1})...")
-                time.sleep(retry_delay)
+pool = None
+POOL_LOCK = asyncio.Lock()  # Held while the pool is created, so callers arriving meanwhile wait for it instead of opening pools of their own
+
+async def create_db_pool():
+    global pool
+    if pool is not None:
+        return pool
+    async with POOL_LOCK:
+        if pool is None:
+            retry_delay = 1  # seconds
+            for attempt in range(DB_CONNECT_RETRIES + 1):
+                if attempt:
+                    logging.info(f"Retrying connection (attempt {attempt})...")
                 try:
-                    conn = psycopg2.connect(
+                    pool = await asyncpg.create_pool(
                         host=DB_HOST,
                         user=DB_USER,
                         password=DB_PASSWORD,
-                        database=DB_NAME
+                        database=DB_NAME,
+                        min_size=DB_POOL_MIN_SIZE,
+                        max_size=DB_POOL_MAX_SIZE
                     )
-                    logging.info("Connected to the database after retry.")
+                    logging.info("Connected to the database.")
                     break
-                except OperationalError as e:
-                    logging.error(f"Error connecting to the database (attempt {retry + 1}): {str(e)}")
-                    conn = None
-            
-            if conn is None:
-                raise Exception("Failed to establish a database connection.")
-    
-    return conn
-
-def close_db_connection():
-    global conn
-    if conn is not None and not conn.closed:
-        conn.close()
-        logging.info("Closed the database connection.")
-
-def get_config(guild_id):
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT log_channel_name, log_events, webhook_url FROM config WHERE guild_id = %s", (guild_id,))
-    result = c.fetchone()
+                except (OSError, asyncpg.PostgresError) as e:
+                    logging.error(f"Error connecting to the database (attempt {attempt + 1}): {str(e)}")
+                    if attempt == DB_CONNECT_RETRIES:
+                        raise Exception("Failed to establish a database connection.")
+                    # Back off without blocking the event loop
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, DB_MAX_RETRY_DELAY)
+    return pool
+
+async def close_db_pool():
+    global pool
+    if pool is not None:
+        closing_pool = pool
+        pool = None
+        await closing_pool.close()
+        logging.info("Closed the database connection pool.")
+
+async def monitor_db_health():
+    while True:
+        await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+        if pool is None:
+            continue
+        try:
+            await asyncio.wait_for(pool.fetchval("SELECT 1"), timeout=DB_HEALTH_CHECK_TIMEOUT)
+        except Exception as e:
+            # Drop the pooled connections so the next queries open fresh ones
+            logging.error(f"Database health check failed: {str(e)}")
+            pool.expire_connections()
+
+async def execute_query(method, query, *args):
+    db_pool = await create_db_pool()
+    start_time = time.monotonic()
+    result = await getattr(db_pool, method)(query, *args)
+    observe('db_query_latency_seconds', time.monotonic() - start_time)
+    return result
+
+@asynccontextmanager
+async def schema_transaction():
+    # Every process creates the tables on start, so each one runs its DDL in a transaction holding
+    # the same advisory lock instead of racing the others on the same tables, columns and functions
+    db_pool = await create_db_pool()
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+            yield conn
+
+async def create_config_table():
+    async with schema_transaction() as conn:
+        await conn.execute('''CREATE TABLE IF NOT EXISTS config
+                     (guild_id BIGINT PRIMARY KEY,
+                      log_channel_name TEXT,
+                      log_events TEXT,
+                      webhook_url TEXT)''')
+        # Added after the table was first created, so it is added to existing tables as well
+        await conn.execute("ALTER TABLE config ADD COLUMN IF NOT EXISTS extra_webhook_urls TEXT[]")
+        # Tell every bot process which server's configuration changed, so each one only reloads that server
+        await conn.execute(f'''CREATE OR REPLACE FUNCTION notify_config_change() RETURNS trigger AS $$
+                     BEGIN
+                         PERFORM pg_notify('{CONFIG_CHANGE_CHANNEL}', COALESCE(NEW.guild_id, OLD.guild_id)::text);
+                         RETURN NULL;
+                     END;
+                     $$ LANGUAGE plpgsql''')
+        await conn.execute('''DO $$ BEGIN
+                     IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'config_changed') THEN
+                         CREATE TRIGGER config_changed AFTER INSERT OR UPDATE OR DELETE ON config
+                         FOR EACH ROW EXECUTE FUNCTION notify_config_change();
+                     END IF;
+                     END $$''')
+
+def get_webhook_urls(row):
+    # The log channel's pool of webhooks, webhook_url is the first and extra_webhook_urls the rest
+    if not row['webhook_url']:
+        return []
+    return [row['webhook_url']] + (row['extra_webhook_urls'] or [])
+
+async def get_config(guild_id):
+    result = await execute_query('fetchrow', "SELECT log_channel_name, log_events, webhook_url, extra_webhook_urls FROM config WHERE guild_id = $1", guild_id)
     if result:
-        log_channel_name, log_events, webhook_url = result
+        log_channel_name, log_events = result['log_channel_name'], result['log_events']
         if not log_events:
             log_events = ""
-        return log_channel_name, log_events, webhook_url
+        return log_channel_name, log_events, get_webhook_urls(result)
     else:
-        return None, "", None
-
-def set_config(guild_id, log_channel_name, log_events):
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute("INSERT INTO config (guild_id, log_channel_name, log_events) VALUES (%s, %s, %s) ON CONFLICT (guild_id) DO UPDATE SET log_channel_name = EXCLUDED.log_channel_name, log_events = EXCLUDED.log_events",
-              (guild_id, log_channel_name, log_events))
-    conn.commit()
-
-def remove_config(guild_id):
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM config WHERE guild_id = %s", (guild_id,))
-    conn.commit()
-
-def set_webhook_url(guild_id, webhook_url):
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE config SET webhook_url = %s WHERE guild_id = %s", (webhook_url, guild_id))
-    conn.commit()
-
-def get_webhook_url(guild_id):
-    conn = create_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT webhook_url FROM config WHERE guild_id = %s", (guild_id,))
-    result = c.fetchone()
-    return result[0] if result else None
\ No newline at end of file
+        return None, "", []
+
+async def get_configs(guild_ids):
+    # Load the configuration of many servers with one query, servers without a row are left out.
+    # log_events is None when the events were never set and "" when every event was turned off
+    rows = await execute_query('fetch', "SELECT guild_id, log_channel_name, log_events, webhook_url, extra_webhook_urls FROM config WHERE guild_id = ANY($1::bigint[])", list(guild_ids))
+    return {row['guild_id']: (row['log_channel_name'], row['log_events'], get_webhook_urls(row)) for row in rows}
+
+async def set_default_configs(guild_channels, log_events):
+    # Upsert many (guild_id, log_channel_name) pairs with the same log events in one statement
+    if not guild_channels:
+        return
+    guild_ids = [guild_id for guild_id, _ in guild_channels]
+    log_channel_names = [log_channel_name for _, log_channel_name in guild_channels]
+    await execute_query('execute', """INSERT INTO config (guild_id, log_channel_name, log_events)
+                                      SELECT guild_id, log_channel_name, $3 FROM unnest($1::bigint[], $2::text[]) AS t (guild_id, log_channel_name)
+                                      ON CONFLICT (guild_id) DO UPDATE SET log_channel_name = EXCLUDED.log_channel_name, log_events = EXCLUDED.log_events""",
+                        guild_ids, log_channel_names, log_events)
+
+async def set_config(guild_id, log_channel_name, log_events):
+    # None leaves that setting as it is
+    await execute_query('execute', """INSERT INTO config (guild_id, log_channel_name, log_events) VALUES ($1, $2, $3)
+                                      ON CONFLICT (guild_id) DO UPDATE SET log_channel_name = COALESCE(EXCLUDED.log_channel_name, config.log_channel_name),
+                                                                           log_events = COALESCE(EXCLUDED.log_events, config.log_events)""",
+                        guild_id, log_channel_name, log_events)
+
+async def remove_config(guild_id):
+    await execute_query('execute', "DELETE FROM config WHERE guild_id = $1", guild_id)
+
+async def set_webhook_url(guild_id, webhook_url, extra_webhook_urls=()):
+    # extra_webhook_urls are the rest of the log channel's pool after webhook_url
+    await execute_query('execute', "UPDATE config SET webhook_url = $1, extra_webhook_urls = $2 WHERE guild_id = $3", webhook_url, list(extra_webhook_urls), guild_id)
+
+async def get_webhook_url(guild_id):
+    result = await execute_query('fetchrow', "SELECT webhook_url FROM config WHERE guild_id = $1", guild_id)
+    return result[0] if result else None
+
+async def listen_for_config_changes(refresh):
+    # Calls refresh with the IDs of servers whose configuration changed, possibly in another process.
+    # refresh(None) means notifications may have been missed and everything should be reloaded
+    changed_guild_ids = set()
+    changes_pending = asyncio.Event()
+
+    def on_notify(connection, pid, channel, payload):
+        changed_guild_ids.add(int(payload))
+        changes_pending.set()
+
+    async def apply_changes():
+        while True:
+            await changes_pending.wait()
+            changes_pending.clear()
+            # A burst of notifications, like the defaults written on startup, is applied in one go
+            guild_ids = set(changed_guild_ids)
+            changed_guild_ids.clear()
+            try:
+                await refresh(guild_ids)
+            except Exception as e:
+                logging.error(f"Error refreshing the configuration of {len(guild_ids)} servers: {str(e)}")
+
+    apply_task = asyncio.create_task(apply_changes())
+    listened_before = False
+    try:
+        while True:
+            conn = None
+            try:
+                # LISTEN needs a connection of its own, the pool hands connections out and recycles them
+                conn = await asyncpg.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
+                await conn.add_listener(CONFIG_CHANGE_CHANNEL, on_notify)
+                if listened_before:
+                    await refresh(None)
+                listened_before = True
+                logging.info("Listening for configuration changes.")
+                # Notifications arrive on their own, this only notices a connection that silently died
+                while True:
+                    await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+                    await asyncio.wait_for(conn.fetchval("SELECT 1"), timeout=DB_HEALTH_CHECK_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Configuration change listener failed, reconnecting in {CONFIG_LISTEN_RETRY_DELAY} seconds: {str(e)}")
+            finally:
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(CONFIG_LISTEN_RETRY_DELAY)
+    finally:
+        apply_task.cancel()
@@ -1,4 +1,55 @@
-from bot import bot
-from config import DISCORD_TOKEN
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+import config
+from config import DISCORD_TOKEN, SHARD_COUNT, SHARD_PROCESSES
 
-bot.run(DISCORD_TOKEN)
+RESTART_DELAY = 5  # Seconds before restarting a shard process that exited
+
+def run_bot(process_index=0, shard_ids=None):
+    if shard_ids is not None:
+        config.SHARD_IDS = shard_ids
+        config.PROCESS_INDEX = process_index
+    # Imported here so the bot is built after this process knows which shards it runs
+    from bot import bot
+    bot.run(DISCORD_TOKEN)
+
+def split_shards(shard_count, processes):
+    # Contiguous shard ranges, the first processes take one extra shard when they don't divide evenly.
+    # Never returns an empty range, discord.py runs every shard when given no shard IDs
+    processes = min(processes, shard_count)
+    base, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + base + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def start_shard_process(context, process_index, shard_ids):
+    process = context.Process(target=run_bot, args=(process_index, shard_ids), name=f"loggerhead-{process_index}")
+    process.start()
+    logging.info(f"Started process {process_index} (pid {process.pid}) for shards {shard_ids}")
+    return process
+
+def launch_shards():
+    # Each process gets a fresh interpreter with its own event loop, caches and database pool
+    context = multiprocessing.get_context('spawn')
+    shard_ranges = split_shards(SHARD_COUNT, SHARD_PROCESSES)
+    processes = {index: start_shard_process(context, index, shard_ids) for index, shard_ids in enumerate(shard_ranges)}
+    while True:
+        multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+        for index, process in list(processes.items()):
+            if process.exitcode is not None:
+                logging.error(f"Process {index} for shards {shard_ranges[index]} exited with code {process.exitcode}, restarting in {RESTART_DELAY} seconds")
+                time.sleep(RESTART_DELAY)
+                processes[index] = start_shard_process(context, index, shard_ranges[index])
+
+if __name__ == '__main__':
+    if SHARD_COUNT and SHARD_PROCESSES > 1:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        launch_shards()
+    else:
+        run_bot()
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+from config import create_db_pool, execute_query, schema_transaction, MESSAGE_RETENTION, MESSAGE_CACHE_BUDGET, MESSAGE_CACHE_GUILD_BUDGET, MESSAGE_CACHE_TTL
+from metrics import observe, set_gauge
+
+MESSAGE_FLUSH_INTERVAL = 5  # Seconds between flushes of buffered messages to the database
+MESSAGE_FLUSH_SIZE = 500  # Flush early once this many messages are buffered
+MESSAGE_RETENTION_INTERVAL = 300  # Seconds between passes trimming servers down to MESSAGE_RETENTION messages
+MESSAGE_PARTITIONS = 16  # Hash partitions of the messages table, by server
+RECORD_OVERHEAD = 300  # Rough bytes for a StoredMessage with its IDs, timestamp and cache bookkeeping
+
+MESSAGE_COLUMNS = ('message_id', 'guild_id', 'channel_id', 'author_id', 'content', 'attachments', 'created_at')
+
+class StoredMessage:
+    # Only what the delete and edit logs render, a small fraction of a full discord.Message
+    __slots__ = MESSAGE_COLUMNS + ('size', 'cached_at')
+
+    def __init__(self, message_id, guild_id, channel_id, author_id, content, attachments, created_at):
+        self.message_id = message_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.attachments = tuple(attachments) if attachments else ()
+        self.created_at = created_at
+        self.cached_at = 0.0
+        self.set_content(content)
+
+    def set_content(self, content):
+        self.content = content
+        self.size = RECORD_OVERHEAD + sys.getsizeof(content or '') + sum(len(url) for url in self.attachments)
+
+    def as_row(self):
+        return tuple(getattr(self, column) for column in MESSAGE_COLUMNS)
+
+HOT_MESSAGES = {}  # guild_id -> OrderedDict of message_id -> StoredMessage, least recently used first
+HOT_GUILDS = OrderedDict()  # guild_id -> bytes cached for the server, least recently active server first
+HOT_BYTES = 0  # Bytes cached across every server
+PENDING_MESSAGES = {}  # (guild_id, message_id) -> StoredMessage not yet written to the database
+PENDING_EDITS = {}  # (guild_id, message_id) -> new content of messages already in the database
+DIRTY_GUILDS = set()  # Servers with new messages since the last retention pass
+FLUSH_EVENT = asyncio.Event()
+MESSAGE_STORE_TASKS = []
+
+async def create_message_table():
+    # Partitioned by server, and the snowflake message ID orders each server's messages by time
+    async with schema_transaction() as conn:
+        await conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                     (message_id BIGINT NOT NULL,
+                      guild_id BIGINT NOT NULL,
+                      channel_id BIGINT NOT NULL,
+                      author_id BIGINT NOT NULL,
+                      content TEXT,
+                      attachments TEXT[],
+                      created_at TIMESTAMPTZ NOT NULL,
+                      PRIMARY KEY (guild_id, message_id))
+                     PARTITION BY HASH (guild_id)''')
+        for remainder in range(MESSAGE_PARTITIONS):
+            await conn.execute(f'''CREATE TABLE IF NOT EXISTS messages_p{remainder} PARTITION OF messages
+                         FOR VALUES WITH (MODULUS {MESSAGE_PARTITIONS}, REMAINDER {remainder})''')
+
+def evict_oldest_hot(guild_id):
+    global HOT_BYTES
+    guild_messages = HOT_MESSAGES[guild_id]
+    _, stored_message = guild_messages.popitem(last=False)
+    HOT_GUILDS[guild_id] -= stored_message.size
+    HOT_BYTES -= stored_message.size
+    if not guild_messages:
+        del HOT_MESSAGES[guild_id]
+        del HOT_GUILDS[guild_id]
+
+def forget_hot(guild_id, message_id):
+    global HOT_BYTES
+    guild_messages = HOT_MESSAGES.get(guild_id)
+    stored_message = guild_messages.pop(message_id, None) if guild_messages else None
+    if stored_message is not None:
+        HOT_GUILDS[guild_id] -= stored_message.size
+        HOT_BYTES -= stored_message.size
+        if not guild_messages:
+            del HOT_MESSAGES[guild_id]
+            del HOT_GUILDS[guild_id]
+    return stored_message
+
+def expire_hot(guild_id, now):
+    # Least recently used is first, so expired messages are always at the front
+    guild_messages = HOT_MESSAGES.get(guild_id)
+    while guild_messages and now - next(iter(guild_messages.values())).cached_at > MESSAGE_CACHE_TTL:
+        evict_oldest_hot(guild_id)
+        guild_messages = HOT_MESSAGES.get(guild_id)
+
+def remember_hot(stored_message):
+    global HOT_BYTES
+    guild_id = stored_message.guild_id
+    forget_hot(guild_id, stored_message.message_id)
+    now = time.monotonic()
+    stored_message.cached_at = now
+    HOT_MESSAGES.setdefault(guild_id, OrderedDict())[stored_message.message_id] = stored_message
+    HOT_GUILDS[guild_id] = HOT_GUILDS.get(guild_id, 0) + stored_message.size
+    HOT_GUILDS.move_to_end(guild_id)
+    HOT_BYTES += stored_message.size
+
+    # One busy server can't take more than its share
+    while HOT_GUILDS.get(guild_id, 0) > MESSAGE_CACHE_GUILD_BUDGET:
+        evict_oldest_hot(guild_id)
+    expire_hot(guild_id, now)
+    # Over the global budget, take from the server that has been quiet the longest
+    while HOT_BYTES > MESSAGE_CACHE_BUDGET and HOT_GUILDS:
+        evict_oldest_hot(next(iter(HOT_GUILDS)))
+
+def get_hot(guild_id, message_id):
+    guild_messages = HOT_MESSAGES.get(guild_id)
+    stored_message = guild_messages.get(message_id) if guild_messages else None
+    if stored_message is None:
+        return None
+    now = time.monotonic()
+    if now - stored_message.cached_at > MESSAGE_CACHE_TTL:
+        forget_hot(guild_id, message_id)
+        return None
+    stored_message.cached_at = now
+    guild_messages.move_to_end(message_id)
+    HOT_GUILDS.move_to_end(guild_id)
+    return stored_message
+
+def expire_hot_messages():
+    now = time.monotonic()
+    for guild_id in list(HOT_GUILDS):
+        expire_hot(guild_id, now)
+    set_gauge('message_cache_bytes', HOT_BYTES)
+    set_gauge('message_cache_messages', sum(len(guild_messages) for guild_messages in HOT_MESSAGES.values()))
+
+def store_message(message):
+    key = (message.guild.id, message.id)
+    stored_message = StoredMessage(
+        message.id,
+        message.guild.id,
+        message.channel.id,
+        message.author.id,
+        message.content,
+        [attachment.url for attachment in message.attachments],
+        message.created_at
+    )
+    PENDING_MESSAGES[key] = stored_message
+    DIRTY_GUILDS.add(message.guild.id)
+    remember_hot(stored_message)
+    if len(PENDING_MESSAGES) >= MESSAGE_FLUSH_SIZE:
+        FLUSH_EVENT.set()
+
+def update_message_content(guild_id, message_id, content):
+    key = (guild_id, message_id)
+    stored_message = forget_hot(guild_id, message_id)
+    if stored_message is not None:
+        # Re-added so the cache accounts for the new size
+        stored_message.set_content(content)
+        remember_hot(stored_message)
+    pending_message = PENDING_MESSAGES.get(key)
+    if pending_message is not None:
+        # Not written yet, so the insert can carry the new content
+        pending_message.set_content(content)
+    else:
+        PENDING_EDITS[key] = content
+
+def load_stored_message(row):
+    stored_message = StoredMessage(*row)
+    content = PENDING_EDITS.get((stored_message.guild_id, stored_message.message_id))
+    if content is not None:
+        stored_message.set_content(content)
+    return stored_message
+
+async def get_message(guild_id, message_id):
+    stored_message = get_hot(guild_id, message_id) or PENDING_MESSAGES.get((guild_id, message_id))
+    if stored_message is not None:
+        return stored_message
+
+    row = await execute_query('fetchrow', f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE guild_id = $1 AND message_id = $2", guild_id, message_id)
+    if row is None:
+        return None
+    stored_message = load_stored_message(row)
+    remember_hot(stored_message)
+    return stored_message
+
+async def get_messages(guild_id, message_ids):
+    # Like get_message for many messages, with a single query for the ones not held in memory
+    found = {}
+    missing_ids = []
+    for message_id in message_ids:
+        stored_message = get_hot(guild_id, message_id) or PENDING_MESSAGES.get((guild_id, message_id))
+        if stored_message is not None:
+            found[message_id] = stored_message
+        else:
+            missing_ids.append(message_id)
+
+    if missing_ids:
+        rows = await execute_query('fetch', f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE guild_id = $1 AND message_id = ANY($2::bigint[])", guild_id, missing_ids)
+        for row in rows:
+            stored_message = load_stored_message(row)
+            found[stored_message.message_id] = stored_message
+    return found
+
+async def flush_messages():
+    global PENDING_MESSAGES, PENDING_EDITS
+    if not PENDING_MESSAGES and not PENDING_EDITS:
+        return
+    # Swap the buffers out first, messages arriving during the flush go into fresh ones
+    messages, PENDING_MESSAGES = PENDING_MESSAGES, {}
+    edits, PENDING_EDITS = PENDING_EDITS, {}
+
+    db_pool = await create_db_pool()
+    start_time = time.monotonic()
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if messages:
+                    # COPY into a staging table, then insert from it so a duplicate doesn't fail the whole batch
+                    await conn.execute("CREATE TEMP TABLE IF NOT EXISTS messages_staging (LIKE messages) ON COMMIT DELETE ROWS")
+                    await conn.copy_records_to_table('messages_staging', records=[stored_message.as_row() for stored_message in messages.values()], columns=MESSAGE_COLUMNS)
+                    await conn.execute("INSERT INTO messages SELECT * FROM messages_staging ON CONFLICT DO NOTHING")
+                if edits:
+                    await conn.executemany("UPDATE messages SET content = $3 WHERE guild_id = $1 AND message_id = $2",
+                                           [(guild_id, message_id, content) for (guild_id, message_id), content in edits.items()])
+    except Exception as e:
+        logging.error(f"Error flushing {len(messages)} messages and {len(edits)} edits to the database: {str(e)}")
+        # Put them back so the next flush tries again, newer entries win
+        PENDING_MESSAGES = {**messages, **PENDING_MESSAGES}
+        PENDING_EDITS = {**edits, **PENDING_EDITS}
+        return
+    observe('db_query_latency_seconds', time.monotonic() - start_time)
+    logging.debug(f"flush_messages: Wrote {len(messages)} messages and {len(edits)} edits")
+
+async def trim_messages():
+    guild_ids = list(DIRTY_GUILDS)
+    DIRTY_GUILDS.clear()
+    for guild_id in guild_ids:
+        # Keep the newest MESSAGE_RETENTION messages, snowflake IDs sort by time
+        await execute_query('execute', '''DELETE FROM messages WHERE guild_id = $1 AND message_id < (
+                                             SELECT message_id FROM messages WHERE guild_id = $1
+                                             ORDER BY message_id DESC OFFSET $2 LIMIT 1)''', guild_id, MESSAGE_RETENTION - 1)
+
+async def flush_messages_periodically():
+    while True:
+        try:
+            await asyncio.wait_for(FLUSH_EVENT.wait(), timeout=MESSAGE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        FLUSH_EVENT.clear()
+        try:
+            await flush_messages()
+        except Exception as e:
+            logging.error(f"Error in flush_messages_periodically: {str(e)}")
+
+async def trim_messages_periodically():
+    while True:
+        await asyncio.sleep(MESSAGE_RETENTION_INTERVAL)
+        expire_hot_messages()
+        try:
+            await trim_messages()
+        except Exception as e:
+            logging.error(f"Error in trim_messages_periodically: {str(e)}")
+
+def start_message_store():
+    MESSAGE_STORE_TASKS.append(asyncio.create_task(flush_messages_periodically()))
+    MESSAGE_STORE_TASKS.append(asyncio.create_task(trim_messages_periodically()))
@@ -0,0 +1,188 @@
+import asyncio
+import bisect
+import logging
+import time
+from aiohttp import web
+
+WINDOW_SECONDS = 60  # How many seconds of per-second counts are kept
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Upper bounds in seconds
+ENDPOINTS = ('webhook', 'audit_log', 'rest')  # Classes of Discord requests we keep separate counts for
+METRIC_PREFIX = 'loggerhead_'
+LOOP_LAG_INTERVAL = 1.0  # Seconds between event loop lag measurements
+
+# Prometheus style metrics, keyed by (metric name, sorted label items)
+COUNTERS = {}
+GAUGES = {}
+HISTOGRAMS = {}
+COUNTER_ARRAYS = []  # (name, label name, label values, other labels, counts) of counters kept as plain lists
+METRICS_RUNNER = None
+
+class RingCounter:
+    # Per-second counts for the last WINDOW_SECONDS seconds, kept in a fixed-size ring so
+    # counting a request never allocates
+    def __init__(self, size=WINDOW_SECONDS):
+        self.size = size
+        self.buckets = [0] * size
+        self.last_second = int(time.time())
+
+    def _advance(self, second):
+        if second <= self.last_second:
+            return
+        if second - self.last_second >= self.size:
+            for index in range(self.size):
+                self.buckets[index] = 0
+        else:
+            # Zero the slots for the seconds that passed without any requests
+            for skipped in range(self.last_second + 1, second + 1):
+                self.buckets[skipped % self.size] = 0
+        self.last_second = second
+
+    def add(self, amount=1):
+        second = int(time.time())
+        self._advance(second)
+        self.buckets[second % self.size] += amount
+
+    def total(self):
+        self._advance(int(time.time()))
+        return sum(self.buckets)
+
+class LatencyHistogram:
+    # Cumulative histogram with fixed bucket bounds. Percentiles can be taken over everything or
+    # over the observations since an earlier snapshot()
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last slot counts everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return list(self.counts)
+
+    def percentile(self, quantile, since=None):
+        counts = self.counts if since is None else [now - before for now, before in zip(self.counts, since)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = quantile * total
+        running = 0
+        for index, count in enumerate(counts):
+            running += count
+            if running >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+def counter_array(name, label, values, **labels):
+    # Counts indexed like values, for hot paths where even building a label key costs too much.
+    # Callers add to the returned list directly
+    counts = [0] * len(values)
+    COUNTER_ARRAYS.append((name, label, tuple(values), tuple(sorted(labels.items())), counts))
+    return counts
+
+def set_gauge(name, value, **labels):
+    GAUGES[(name, tuple(sorted(labels.items())))] = value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = HISTOGRAMS.get(key)
+    if histogram is None:
+        histogram = HISTOGRAMS[key] = LatencyHistogram()
+    histogram.observe(value)
+
+REQUEST_COUNTS = {endpoint: RingCounter() for endpoint in ENDPOINTS}
+REQUEST_LATENCIES = {endpoint: LatencyHistogram() for endpoint in ENDPOINTS}
+GUILD_REQUEST_COUNTS = {}  # Dictionary to store a RingCounter of requests made for each server
+
+# The request latency histograms are also exported on the metrics endpoint
+for endpoint in ENDPOINTS:
+    HISTOGRAMS[('request_latency_seconds', (('endpoint', endpoint),))] = REQUEST_LATENCIES[endpoint]
+
+def record_request(endpoint, guild_id=None, latency=None):
+    REQUEST_COUNTS[endpoint].add()
+    increment('requests_total', endpoint=endpoint)
+    if latency is not None:
+        REQUEST_LATENCIES[endpoint].observe(latency)
+    if guild_id is not None:
+        counter = GUILD_REQUEST_COUNTS.get(guild_id)
+        if counter is None:
+            counter = GUILD_REQUEST_COUNTS[guild_id] = RingCounter()
+        counter.add()
+
+def get_guild_request_counts():
+    counts = {}
+    for guild_id, counter in list(GUILD_REQUEST_COUNTS.items()):
+        total = counter.total()
+        if total:
+            counts[guild_id] = total
+        else:
+            # Servers that have gone quiet for a whole window don't need a counter any more
+            del GUILD_REQUEST_COUNTS[guild_id]
+    return counts
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in items) + '}'
+
+def render_prometheus():
+    lines = []
+    counters = dict(COUNTERS)
+    for name, label, values, labels, counts in COUNTER_ARRAYS:
+        for value, count in zip(values, counts):
+            if count:
+                key = (name, tuple(sorted(labels + ((label, value),))))
+                counters[key] = counters.get(key, 0) + count
+    for metrics, metric_type in ((counters, 'counter'), (GAUGES, 'gauge')):
+        declared = set()
+        for (name, labels), value in sorted(metrics.items()):
+            if name not in declared:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+                declared.add(name)
+            lines.append(f"{METRIC_PREFIX}{name}{format_labels(labels)} {value}")
+
+    declared = set()
+    for (name, labels), histogram in sorted(HISTOGRAMS.items(), key=lambda item: item[0]):
+        if name not in declared:
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+            declared.add(name)
+        # Prometheus buckets are cumulative
+        running = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            running += count
+            lines.append(f"{METRIC_PREFIX}{name}_bucket{format_labels(labels, [('le', bound)])} {running}")
+        lines.append(f"{METRIC_PREFIX}{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+        lines.append(f"{METRIC_PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+        lines.append(f"{METRIC_PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics(request):
+    return web.Response(body=render_prometheus().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_metrics_server(host, port):
+    global METRICS_RUNNER
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    METRICS_RUNNER = web.AppRunner(app)
+    await METRICS_RUNNER.setup()
+    await web.TCPSite(METRICS_RUNNER, host, port).start()
+    asyncio.create_task(monitor_event_loop_lag())
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+async def monitor_event_loop_lag():
+    # Anything that blocks the event loop makes this sleep overshoot
+    while True:
+        start_time = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe('event_loop_lag_seconds', max(0.0, time.monotonic() - start_time - LOOP_LAG_INTERVAL))
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import discord
+from config import OUTBOX_MAX_BYTES
+from metrics import increment, set_gauge
+
+OUTBOX_COMMIT_INTERVAL = 0.05  # Seconds appends and acknowledgements are gathered for before one commit
+OUTBOX_CHECKPOINT_INTERVAL = 60  # Seconds between WAL checkpoints and disk budget checks
+
+OUTBOX = None  # sqlite3 connection, only ever used from OUTBOX_EXECUTOR's one thread
+OUTBOX_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+NEXT_ENTRY_ID = 1
+PENDING_APPENDS = []  # (entry ID, guild_id, event name, embed JSON) waiting for the next commit
+PENDING_ACKS = []  # Entry IDs delivered since the last commit
+COMMIT_WAITERS = []  # Futures of appends waiting for the next commit
+COMMIT_EVENT = asyncio.Event()
+OUTBOX_TASKS = []
+
+def _open(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")  # One fsync per group commit, not per event
+    conn.execute('''CREATE TABLE IF NOT EXISTS outbox
+                    (id INTEGER PRIMARY KEY,
+                     guild_id INTEGER NOT NULL,
+                     event_name TEXT NOT NULL,
+                     embed TEXT NOT NULL)''')
+    entries = conn.execute("SELECT id, guild_id, event_name, embed FROM outbox ORDER BY id").fetchall()
+    return conn, entries
+
+def _commit(appends, acks):
+    OUTBOX.execute("BEGIN")
+    try:
+        OUTBOX.executemany("INSERT INTO outbox (id, guild_id, event_name, embed) VALUES (?, ?, ?, ?)", appends)
+        OUTBOX.executemany("DELETE FROM outbox WHERE id = ?", [(entry_id,) for entry_id in acks])
+        OUTBOX.execute("COMMIT")
+    except Exception:
+        OUTBOX.execute("ROLLBACK")
+        raise
+
+def _checkpoint():
+    # Fold the WAL back into the database so it doesn't keep growing
+    OUTBOX.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    page_size = OUTBOX.execute("PRAGMA page_size").fetchone()[0]
+    used_pages = OUTBOX.execute("PRAGMA page_count").fetchone()[0] - OUTBOX.execute("PRAGMA freelist_count").fetchone()[0]
+    used_bytes = used_pages * page_size
+    entries = OUTBOX.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    dropped = 0
+    if used_bytes > OUTBOX_MAX_BYTES and entries:
+        # Over budget, drop the oldest entries. Anything that old is left over from sends that failed
+        dropped = min(entries, (used_bytes - OUTBOX_MAX_BYTES) * entries // used_bytes + 1)
+        OUTBOX.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (dropped,))
+        entries -= dropped
+    return used_bytes, entries, dropped
+
+async def open_outbox(path):
+    # Returns the (entry ID, guild_id, event name, embed) entries the last run never delivered
+    global OUTBOX, NEXT_ENTRY_ID
+    loop = asyncio.get_running_loop()
+    OUTBOX, rows = await loop.run_in_executor(OUTBOX_EXECUTOR, _open, path)
+    if rows:
+        NEXT_ENTRY_ID = rows[-1][0] + 1
+    OUTBOX_TASKS.append(asyncio.create_task(commit_outbox_periodically()))
+    OUTBOX_TASKS.append(asyncio.create_task(checkpoint_outbox_periodically()))
+    logging.info(f"Opened the outbox at {path} with {len(rows)} undelivered events.")
+    return [(entry_id, guild_id, event_name, discord.Embed.from_dict(json.loads(embed))) for entry_id, guild_id, event_name, embed in rows]
+
+async def append_to_outbox(guild_id, event_name, embed):
+    # Returns the entry's ID once it is on disk, or None when there is no outbox
+    global NEXT_ENTRY_ID
+    if OUTBOX is None:
+        return None
+    entry_id = NEXT_ENTRY_ID
+    NEXT_ENTRY_ID += 1
+    PENDING_APPENDS.append((entry_id, guild_id, event_name, json.dumps(embed.to_dict())))
+    future = asyncio.get_running_loop().create_future()
+    COMMIT_WAITERS.append(future)
+    COMMIT_EVENT.set()
+    await future
+    return entry_id
+
+def acknowledge(entry_ids):
+    # Delivered events are removed with the next commit
+    entry_ids = [entry_id for entry_id in entry_ids if entry_id is not None]
+    if entry_ids and OUTBOX is not None:
+        PENDING_ACKS.extend(entry_ids)
+        COMMIT_EVENT.set()
+
+async def commit_outbox_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await COMMIT_EVENT.wait()
+        # Give other events a moment to join, so one fsync covers all of them
+        await asyncio.sleep(OUTBOX_COMMIT_INTERVAL)
+        COMMIT_EVENT.clear()
+        appends = PENDING_APPENDS[:]
+        acks = PENDING_ACKS[:]
+        waiters = COMMIT_WAITERS[:]
+        del PENDING_APPENDS[:], PENDING_ACKS[:], COMMIT_WAITERS[:]
+        try:
+            await loop.run_in_executor(OUTBOX_EXECUTOR, _commit, appends, acks)
+        except Exception as e:
+            # The events are still delivered from memory, they just won't survive a restart
+            logging.error(f"Error committing {len(appends)} events and {len(acks)} acknowledgements to the outbox: {str(e)}")
+            increment('outbox_commit_errors_total')
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+async def checkpoint_outbox_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(OUTBOX_CHECKPOINT_INTERVAL)
+        try:
+            used_bytes, entries, dropped = await loop.run_in_executor(OUTBOX_EXECUTOR, _checkpoint)
+        except Exception as e:
+            logging.error(f"Error checkpointing the outbox: {str(e)}")
+            continue
+        set_gauge('outbox_bytes', used_bytes)
+        set_gauge('outbox_entries', entries)
+        if dropped:
+            logging.warning(f"Outbox over its {OUTBOX_MAX_BYTES} byte budget, dropped the {dropped} oldest events")
+            increment('events_dropped_total', dropped, event='all', reason='outbox_full')
@@ -0,0 +1,138 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+RECORD_FLUSH_INTERVAL = 1  # Seconds between writes of recorded events to the file
+SALT_BYTES = 16
+
+# Recordings are gzipped JSON lines of [Unix time, event name, guild_id, payload]. Each run appends to
+# the file, so times are wall clock rather than offsets from when this process started.
+# IDs are replaced with salted hashes and message content with its length, so a recording keeps the
+# shape of the traffic without anything that identifies people or what they said
+RECORDING = None
+
+# Events the bot.py handlers receive
+RECORDED_EVENTS = (
+    'audit_log_entry_create', 'guild_channel_create', 'guild_channel_delete', 'guild_channel_update',
+    'guild_emojis_update', 'guild_role_create', 'guild_role_delete', 'guild_role_update', 'guild_update',
+    'invite_create', 'invite_delete', 'member_join', 'member_remove', 'member_ban', 'member_kick', 'member_unban', 'member_update',
+    'member_timeout', 'member_remove_timeout',
+    'message_delete', 'message_edit', 'raw_message_delete', 'raw_bulk_message_delete', 'raw_message_edit',
+    'reaction_add', 'reaction_remove', 'voice_state_update', 'webhooks_update',
+)
+
+def load_salt(path):
+    # Every run appends to the same recording, so the salt is kept next to it and reused, otherwise the
+    # same server would hash to a different ID after each restart. Anyone with the salt could reverse the
+    # hashed IDs by brute force, so only its owner can read it and it isn't meant to be shared
+    salt_path = f"{path}.salt"
+    try:
+        with open(salt_path, 'rb') as file:
+            salt = file.read()
+        if len(salt) == SALT_BYTES:
+            return salt
+    except FileNotFoundError:
+        pass
+    salt = os.urandom(SALT_BYTES)
+    with os.fdopen(os.open(salt_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+        file.write(salt)
+    return salt
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        self.salt = load_salt(path)
+        self.buffer = []
+        self.task = None
+
+    def scrub_id(self, value):
+        if value is None:
+            return None
+        digest = hashlib.blake2b(str(value).encode(), key=self.salt, digest_size=7).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, event_name, guild_id, payload):
+        self.buffer.append(json.dumps([round(time.time(), 3), event_name, self.scrub_id(guild_id), payload], separators=(',', ':')))
+
+    def _write(self, lines):
+        with gzip.open(self.path, 'at') as file:
+            file.write('\n'.join(lines) + '\n')
+
+    async def flush_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(RECORD_FLUSH_INTERVAL)
+            if not self.buffer:
+                continue
+            lines = self.buffer
+            self.buffer = []
+            try:
+                # Each flush appends a gzip member, readers see them as one stream
+                await loop.run_in_executor(None, self._write, lines)
+            except Exception as e:
+                logging.error(f"Error writing {len(lines)} recorded events to {self.path}: {str(e)}")
+
+def extract_payload(recording, event_name, args):
+    # The minimal payload benchmark.py needs to rebuild each event, as (guild_id, payload)
+    scrub = recording.scrub_id
+    if event_name in ('reaction_add', 'reaction_remove'):
+        reaction, user = args
+        return reaction.message.guild.id, {'u': scrub(user.id), 'm': scrub(reaction.message.id), 'e': str(reaction.emoji)}
+    if event_name in ('member_join', 'member_remove'):
+        member, = args
+        return member.guild.id, {'u': scrub(member.id)}
+    if event_name == 'voice_state_update':
+        member, before, after = args
+        return member.guild.id, {'u': scrub(member.id), 'b': scrub(getattr(before.channel, 'id', None)), 'a': scrub(getattr(after.channel, 'id', None))}
+    if event_name == 'member_update':
+        before, after = args
+        return after.guild.id, {'u': scrub(after.id), 'rb': [scrub(role.id) for role in before.roles], 'ra': [scrub(role.id) for role in after.roles], 'n': before.nick != after.nick}
+    if event_name == 'message_edit':
+        before, after = args
+        return after.guild.id, {'u': scrub(after.author.id), 'c': scrub(after.channel.id), 'lb': len(before.content or ''), 'la': len(after.content or '')}
+    if event_name == 'message_delete':
+        message, = args
+        return message.guild.id, {'u': scrub(message.author.id), 'c': scrub(message.channel.id), 'l': len(message.content or '')}
+    if event_name == 'raw_bulk_message_delete':
+        payload, = args
+        return payload.guild_id, {'c': scrub(payload.channel_id), 'n': len(payload.message_ids)}
+    # Everything else is only recorded by type and server. Raw payloads carry the server ID, other
+    # events have the server as their first argument or as its guild
+    first = args[0]
+    if hasattr(first, 'guild_id'):
+        return first.guild_id, {}
+    return getattr(first, 'guild', first).id, {}
+
+def make_listener(recording, event_name):
+    async def record_event(*args):
+        try:
+            guild_id, payload = extract_payload(recording, event_name, args)
+        except Exception as e:
+            # Direct messages have no server and aren't logged anyway
+            logging.debug(f"record_event: Event Name: {event_name}, Not recorded: {str(e)}")
+            return
+        if guild_id is not None:
+            recording.add(event_name, guild_id, payload)
+    return record_event
+
+def install_recorder(bot, path, event_names):
+    # Opt-in, listens alongside the handlers without changing them
+    global RECORDING
+    RECORDING = Recording(path)
+    for event_name in event_names:
+        bot.add_listener(make_listener(RECORDING, event_name), f"on_{event_name}")
+    logging.info(f"Recording gateway events to {path}")
+
+def start_recorder():
+    if RECORDING is not None:
+        RECORDING.task = asyncio.create_task(RECORDING.flush_periodically())
+
+def read_recording(path):
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py reads config.yaml from the working directory on import, give it one that needs no database
+WORKDIR = tempfile.mkdtemp(prefix='loggerhead-tests-')
+with open(os.path.join(WORKDIR, 'config.yaml'), 'w') as file:
+    yaml.safe_dump({
+        'discord_token': 'tests',
+        'db_host': 'localhost',
+        'db_user': 'tests',
+        'db_password': 'tests',
+        'db_name': 'tests',
+        'outbox_path': '',
+    }, file)
+os.chdir(WORKDIR)
@@ -0,0 +1,120 @@
+import discord
+import utils
+from utils import EMPTY_FIELD_PLACEHOLDER, MAX_EMBED_DESCRIPTION, MAX_EMBED_FIELD_NAME, MAX_EMBED_FIELD_VALUE, MAX_EMBED_FIELDS, MAX_EMBED_TITLE, MAX_EMBEDS_PER_MESSAGE, MAX_MESSAGE_EMBED_CHARACTERS, EventBatch, clamp_embed, truncate
+
+def make_embed(length):
+    return discord.Embed(description='x' * length)
+
+def make_batch(lengths):
+    batch = EventBatch()
+    for index, length in enumerate(lengths):
+        batch.append(make_embed(length), ('member_join', index, 0))
+    return batch
+
+def payload_sizes(batch):
+    return [[len(embed) for embed in embeds] for embeds, _ in batch.take_all_payloads()]
+
+def test_truncate_keeps_short_text():
+    assert truncate('abc', 3) == 'abc'
+
+def test_truncate_marks_cut_text():
+    assert truncate('abcdef', 5) == 'ab...'
+
+def test_clamp_embed_truncates_title_and_description():
+    embed = clamp_embed(discord.Embed(title='t' * 300, description='d' * 5000))
+    assert len(embed.title) == MAX_EMBED_TITLE
+    assert embed.title.endswith('...')
+    assert len(embed.description) == MAX_EMBED_DESCRIPTION
+
+def test_clamp_embed_truncates_fields():
+    embed = discord.Embed()
+    embed.add_field(name='n' * 300, value='v' * 2000, inline=False)
+    clamp_embed(embed)
+    assert len(embed.fields[0].name) == MAX_EMBED_FIELD_NAME
+    assert len(embed.fields[0].value) == MAX_EMBED_FIELD_VALUE
+    assert embed.fields[0].inline is False
+
+def test_clamp_embed_replaces_empty_fields():
+    embed = discord.Embed()
+    embed.add_field(name='', value='content')
+    embed.add_field(name='Content', value='   ')
+    clamp_embed(embed)
+    assert embed.fields[0].name == EMPTY_FIELD_PLACEHOLDER
+    assert embed.fields[0].value == 'content'
+    assert embed.fields[1].name == 'Content'
+    assert embed.fields[1].value == EMPTY_FIELD_PLACEHOLDER
+
+def test_clamp_embed_drops_extra_fields():
+    embed = discord.Embed()
+    for index in range(MAX_EMBED_FIELDS + 5):
+        embed.add_field(name=f"field {index}", value='value')
+    clamp_embed(embed)
+    assert len(embed.fields) == MAX_EMBED_FIELDS
+    assert embed.fields[-1].name == f"field {MAX_EMBED_FIELDS - 1}"
+
+def test_clamp_embed_fits_one_message():
+    embed = discord.Embed(title='t' * MAX_EMBED_TITLE, description='d' * MAX_EMBED_DESCRIPTION)
+    for _ in range(10):
+        embed.add_field(name='n' * 100, value='v' * MAX_EMBED_FIELD_VALUE)
+    clamp_embed(embed)
+    assert len(embed) <= MAX_MESSAGE_EMBED_CHARACTERS
+    assert embed.fields
+
+def test_clamp_embed_leaves_valid_embed_alone():
+    embed = discord.Embed(title='Member joined', description='<@1> joined')
+    embed.add_field(name='Account age', value='3 days')
+    before = embed.to_dict()
+    assert clamp_embed(embed).to_dict() == before
+
+def test_batch_packs_at_most_ten_embeds_per_message():
+    batch = make_batch([10] * (MAX_EMBEDS_PER_MESSAGE * 2 + 3))
+    assert [len(sizes) for sizes in payload_sizes(batch)] == [MAX_EMBEDS_PER_MESSAGE, MAX_EMBEDS_PER_MESSAGE, 3]
+
+def test_batch_keeps_messages_under_the_character_limit():
+    batch = make_batch([2500, 2500, 2500, 1000, 4000])
+    sizes = payload_sizes(batch)
+    assert sizes == [[2500, 2500], [2500, 1000], [4000]]
+    assert all(sum(message) <= MAX_MESSAGE_EMBED_CHARACTERS for message in sizes)
+
+def test_batch_fills_a_message_exactly_to_the_limit():
+    batch = make_batch([3000, 3000, 1])
+    assert payload_sizes(batch) == [[3000, 3000], [1]]
+
+def test_batch_keeps_events_in_order():
+    batch = make_batch([3000] * 5 + [10] * 12)
+    entry_ids = [entry_id for _, events in batch.take_all_payloads() for _, entry_id, _ in events]
+    assert entry_ids == list(range(17))
+
+def test_batch_embeds_match_their_events():
+    batch = make_batch([100, 200, 5000, 300])
+    for embeds, events in batch.take_all_payloads():
+        assert len(embeds) == len(events)
+
+def test_batch_tracks_the_size_of_the_message_being_filled():
+    batch = make_batch([100, 200, 300])
+    assert batch.payload_size == 600
+    assert not batch.full_payloads
+    batch.append(make_embed(MAX_MESSAGE_EMBED_CHARACTERS - 500), ('member_join', 3, 0))
+    assert batch.payload_size == MAX_MESSAGE_EMBED_CHARACTERS - 500
+    assert len(batch.full_payloads) == 1
+
+def test_take_full_payloads_keeps_the_message_being_filled(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'time', lambda: now[0])
+    batch = make_batch([10] * MAX_EMBEDS_PER_MESSAGE)
+    now[0] = 1005.0
+    batch.append(make_embed(10), ('member_join', MAX_EMBEDS_PER_MESSAGE, 0))
+    assert batch.started_at == 1000.0
+    full = batch.take_full_payloads()
+    assert [len(embeds) for embeds, _ in full] == [MAX_EMBEDS_PER_MESSAGE]
+    assert batch
+    assert batch.started_at == 1005.0  # The pending message is now the oldest thing in the batch
+    assert [len(embeds) for embeds, _ in batch.take_all_payloads()] == [1]
+
+def test_take_all_payloads_empties_the_batch():
+    batch = make_batch([10, 20])
+    assert batch
+    batch.take_all_payloads()
+    assert not batch
+    assert batch.payload_size == 0
+    assert batch.take_all_payloads() == []
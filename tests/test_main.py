@@ -0,0 +1,18 @@
+from main import split_shards
+
+def test_split_shards_evenly():
+    assert split_shards(8, 4) == [[0, 1], [2, 3], [4, 5], [6, 7]]
+
+def test_split_shards_gives_the_remainder_to_the_first_processes():
+    assert split_shards(10, 4) == [[0, 1, 2], [3, 4, 5], [6, 7], [8, 9]]
+
+def test_split_shards_covers_every_shard_once():
+    ranges = split_shards(37, 6)
+    assert sorted(shard for shard_ids in ranges for shard in shard_ids) == list(range(37))
+
+def test_split_shards_single_process():
+    assert split_shards(5, 1) == [[0, 1, 2, 3, 4]]
+
+def test_split_shards_never_returns_an_empty_range():
+    # discord.py runs every shard when given no shard IDs
+    assert split_shards(2, 5) == [[0], [1]]
@@ -0,0 +1,72 @@
+import pytest
+import metrics
+from metrics import LatencyHistogram, RingCounter
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metrics.time, 'time', lambda: now[0])
+    return now
+
+def test_ring_counter_totals_the_window(clock):
+    counter = RingCounter(size=5)
+    for _ in range(3):
+        counter.add()
+        clock[0] += 1
+    counter.add(2)
+    assert counter.total() == 5
+
+def test_ring_counter_forgets_seconds_that_left_the_window(clock):
+    counter = RingCounter(size=5)
+    counter.add(3)
+    clock[0] += 4
+    counter.add()
+    assert counter.total() == 4
+    clock[0] += 1
+    assert counter.total() == 1
+
+def test_ring_counter_wraps_around(clock):
+    counter = RingCounter(size=5)
+    for _ in range(12):
+        counter.add()
+        clock[0] += 1
+    clock[0] -= 1
+    assert counter.total() == 5
+    assert counter.buckets == [1] * 5
+
+def test_ring_counter_clears_after_a_long_gap(clock):
+    counter = RingCounter(size=5)
+    counter.add(10)
+    clock[0] += 100
+    assert counter.total() == 0
+    counter.add()
+    assert counter.total() == 1
+
+def test_histogram_percentiles_are_bucket_bounds():
+    histogram = LatencyHistogram(bounds=(0.1, 0.5, 1.0))
+    for value in [0.05] * 50 + [0.3] * 40 + [0.8] * 9 + [2.0]:
+        histogram.observe(value)
+    assert histogram.percentile(0.5) == 0.1
+    assert histogram.percentile(0.9) == 0.5
+    assert histogram.percentile(0.99) == 1.0
+    assert histogram.percentile(1.0) == float('inf')
+    assert histogram.count == 100
+    assert histogram.sum == pytest.approx(0.05 * 50 + 0.3 * 40 + 0.8 * 9 + 2.0)
+
+def test_histogram_bound_values_fall_in_their_bucket():
+    histogram = LatencyHistogram(bounds=(0.1, 0.5))
+    histogram.observe(0.1)
+    assert histogram.percentile(1.0) == 0.1
+
+def test_histogram_percentile_of_nothing_is_none():
+    assert LatencyHistogram().percentile(0.5) is None
+
+def test_histogram_percentile_since_a_snapshot():
+    histogram = LatencyHistogram(bounds=(0.1, 0.5, 1.0))
+    for _ in range(100):
+        histogram.observe(0.05)
+    snapshot = histogram.snapshot()
+    assert histogram.percentile(0.5, since=snapshot) is None
+    histogram.observe(0.7)
+    assert histogram.percentile(0.5, since=snapshot) == 1.0
+    assert histogram.percentile(0.5) == 0.1
@@ -0,0 +1,72 @@
+import math
+import pytest
+import utils
+from utils import BASE_BUSY_THRESHOLD, MAX_BATCH_INTERVAL, MIN_BUSY_THRESHOLD, RATE_WINDOW, DecayingCounter, get_batch_interval, get_event_rate, is_busy_server, record_event
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(utils.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(utils, 'GUILD_RATES', {})
+    monkeypatch.setattr(utils, 'LANE_RATES', {})
+    monkeypatch.setattr(utils, 'GLOBAL_RATE', DecayingCounter())
+    monkeypatch.setattr(utils, 'RAMP_UP_FACTOR', 1.0)
+    return now
+
+def record_events(guild_id, count, lane=0):
+    for _ in range(count):
+        record_event(guild_id, lane)
+
+def test_counter_decays_by_e_every_rate_window(clock):
+    counter = DecayingCounter()
+    counter.add(clock[0], 100)
+    assert counter.value(clock[0] + RATE_WINDOW) == pytest.approx(100 / math.e)
+
+def test_counter_settles_at_rate_times_window(clock):
+    counter = DecayingCounter()
+    for second in range(RATE_WINDOW * 20):
+        counter.add(clock[0] + second)
+    assert counter.value(clock[0] + RATE_WINDOW * 20) == pytest.approx(RATE_WINDOW, rel=0.02)
+
+def test_event_rate_of_unknown_server_is_zero(clock):
+    assert get_event_rate(1) == 0.0
+
+def test_quiet_server_is_not_busy(clock):
+    record_events(1, BASE_BUSY_THRESHOLD // 2)
+    assert not is_busy_server(1)
+
+def test_server_over_the_threshold_is_busy(clock):
+    record_events(1, BASE_BUSY_THRESHOLD)
+    assert is_busy_server(1)
+
+def test_server_stops_being_busy_as_its_rate_decays(clock):
+    record_events(1, BASE_BUSY_THRESHOLD)
+    clock[0] += RATE_WINDOW
+    assert not is_busy_server(1)
+
+def test_busy_fleet_lowers_the_threshold(clock):
+    for guild_id in range(10):
+        record_events(guild_id, BASE_BUSY_THRESHOLD * 4)
+    record_events(100, BASE_BUSY_THRESHOLD // 2)
+    assert is_busy_server(100)
+
+def test_threshold_is_lowest_while_ramping_up(clock, monkeypatch):
+    monkeypatch.setattr(utils, 'RAMP_UP_FACTOR', 0.0)
+    record_events(1, MIN_BUSY_THRESHOLD)
+    assert is_busy_server(1)
+    record_events(2, MIN_BUSY_THRESHOLD - 1)
+    assert not is_busy_server(2)
+
+def test_each_lane_is_busy_on_its_own(clock):
+    record_events(1, BASE_BUSY_THRESHOLD, lane=1)
+    assert is_busy_server(1, lane=1)
+    assert not is_busy_server(1, lane=0)
+
+def test_batch_interval_grows_with_the_rate(clock):
+    quiet = get_batch_interval(1)
+    record_events(1, 20)
+    assert get_batch_interval(1) > quiet
+
+def test_batch_interval_is_capped(clock):
+    record_events(1, BASE_BUSY_THRESHOLD * 100)
+    assert get_batch_interval(1) == MAX_BATCH_INTERVAL
@@ -1,173 +1,576 @@
 import asyncio
 from asyncio import Queue
 import datetime
+import functools
+import math
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
-from RateLimitedWebhook import RateLimitedWebhook
+from RateLimitedWebhook import WebhookDeadError, WebhookError, WebhookRejectedError, get_webhook, remove_webhook
+from config import EVENT_BITS, LOG_EVENTS, PRIORITY_NORMAL, events_to_mask
+from outbox import acknowledge, append_to_outbox
+from metrics import ENDPOINTS, REQUEST_COUNTS, REQUEST_LATENCIES, WINDOW_SECONDS, counter_array, get_guild_request_counts, increment, record_request
 
-BATCH_SEND_INTERVAL = 1  # Interval in seconds to check and send pending batches
-MAX_BATCH_SIZE = 2000  # Maximum size of a batch message in characters
+# Discord's limits for embeds sent in a single webhook message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_MESSAGE_EMBED_CHARACTERS = 6000  # Total characters across every embed in one message
+MAX_EMBED_TITLE = 256
+MAX_EMBED_DESCRIPTION = 4096
+MAX_EMBED_FIELDS = 25
+MAX_EMBED_FIELD_NAME = 256
+MAX_EMBED_FIELD_VALUE = 1024
+EMPTY_FIELD_PLACEHOLDER = "*No text*"  # Stands in for empty field names and values
 RAMP_UP_DURATION = 300  # Ramp-up duration in seconds (e.g. 5 minutes)
+RATE_WINDOW = 60  # Time constant in seconds of the decaying per-server event rates
+BASE_BUSY_THRESHOLD = 100  # Events per RATE_WINDOW before a server is considered busy
+MIN_BUSY_THRESHOLD = 10  # Lowest the busy threshold is allowed to go
+MAX_BATCH_INTERVAL = 30  # Longest a partially filled batch waits, in seconds
+GUILD_QUEUE_SIZE = 1000  # Maximum number of pending events per guild before handlers have to wait
+QUEUE_PUT_TIMEOUT = 5  # Seconds a handler waits for room in a full guild queue before dropping the event
+DELIVERY_WORKERS = 8  # Number of workers draining the guild queues
+DELIVERY_QUANTUM = 20  # Webhook requests a server may spend each time it gets a turn
+BATCHED_EVENT_COST = 1 / MAX_EMBEDS_PER_MESSAGE  # Share of a request charged for an event that only joined a batch
+PRIORITY_CLASSES = sorted(set(LOG_EVENTS.values()))
+EVENT_LANES = {event_name: index for index, event_name in enumerate(LOG_EVENTS)}  # Spreads event types over a server's webhooks
+EVENT_ROUTING = {event_name: (EVENT_BITS[event_name], index) for index, event_name in enumerate(LOG_EVENTS)}  # Bit and counter index of each event
+EVENTS_RECEIVED = counter_array('events_received_total', 'event', LOG_EVENTS)
+EVENTS_DISABLED = counter_array('events_dropped_total', 'event', LOG_EVENTS, reason='disabled')
+RETRY_DELAY = 60  # Seconds before events whose send failed are queued again, longer than a paused webhook's first pause
+MAX_SEND_ATTEMPTS = 5  # Sends an event gets before it is left in the outbox for the next start
+HEAL_RETRY_DELAY = 300  # Seconds before trying again to replace a dead webhook we couldn't replace
 
-BATCH_QUEUE = Queue()
+GUILD_QUEUES = {}  # (guild_id, priority, lane) -> queue of pending events
+READY_GUILDS = {priority: deque() for priority in PRIORITY_CLASSES}  # (guild_id, lane) with pending events in each priority class
+READY_COUNT = asyncio.Semaphore(0)  # Entries across READY_GUILDS, workers wait on this for something to do
+SCHEDULED_GUILDS = set()  # (guild_id, priority, lane) in READY_GUILDS or being drained by a worker
+GUILD_DEFICITS = {}  # (guild_id, priority, lane) -> request allowance carried over to the queue's next turn
+DELIVERY_TASKS = []
+DEFERRED_EVENTS = deque()  # (retry at, guild_id, event name, embed, entry ID, attempts) of events whose send failed, oldest first
+RAMP_UP_TASKS = []
 BATCH_LOCKS = defaultdict(asyncio.Lock)
-REQUEST_COUNTS = defaultdict(int)
-EVENT_COUNTERS = defaultdict(lambda: {'count': 0, 'last_event_time': 0})
+GUILD_RATES = {}  # Dictionary to store the decaying event rate of each server
+LANE_RATES = {}  # (guild_id, lane) -> decaying rate of the events sent through one webhook of the server's pool
+RAMP_UP_FACTOR = 0.0  # Grows from 0 to 1 over RAMP_UP_DURATION after startup, scaling the busy threshold
 EVENT_BATCHES = {}
+FLUSH_TASKS = set()  # Running batch flushes, the event loop only keeps weak references to tasks
 
-LOG_CHANNELS = {}  # Dictionary to store logging channels for each server
-LOG_EVENT_SETTINGS = {}
-LOG_WEBHOOKS = {}  # Dictionary to store logging webhooks for each server
+GUILD_ROUTES = {}  # Dictionary to store the GuildRoute of each server
+WEBHOOK_HEALER = None  # Coroutine function recreating a server's log webhook, registered by bot.py
+HEAL_TASKS = {}  # Webhook URL -> task replacing the dead webhook
+HEAL_FAILURES = {}  # guild_id -> when replacing its webhook last failed
 
-def is_busy_server(guild_id):
-    current_time = time.time()
-    time_window = 60  # Time window in seconds
-    
-    if current_time - EVENT_COUNTERS[guild_id]['last_event_time'] > time_window:
-        EVENT_COUNTERS[guild_id]['count'] = 0
-    
-    event_count = EVENT_COUNTERS[guild_id]['count']
-    base_threshold = 100  # Base threshold for considering a server as busy
-    
-    # Calculate the average event count per guild
-    total_event_count = sum(counter['count'] for counter in EVENT_COUNTERS.values())
-    num_guilds = len(EVENT_COUNTERS)
-    avg_event_count = total_event_count / num_guilds
+class DecayingCounter:
+    # Exponentially decayed event count. At a steady r events per second it settles at r * RATE_WINDOW,
+    # roughly the number of events seen in the last RATE_WINDOW seconds, and both updating and reading it are O(1)
+    def __init__(self):
+        self.count = 0.0
+        self.updated_at = time.monotonic()
+
+    def value(self, now):
+        return self.count * math.exp((self.updated_at - now) / RATE_WINDOW)
+
+    def add(self, now, amount=1):
+        self.count = self.value(now) + amount
+        self.updated_at = now
+
+# Every counter decays at the same rate, so one counter fed by all servers always equals the sum of the
+# per-server counters and the fleet average doesn't need a walk over every server
+GLOBAL_RATE = DecayingCounter()
+
+def record_event(guild_id, lane=0):
+    now = time.monotonic()
+    rate = GUILD_RATES.get(guild_id)
+    if rate is None:
+        rate = GUILD_RATES[guild_id] = DecayingCounter()
+    rate.add(now)
+    GLOBAL_RATE.add(now)
+    lane_rate = LANE_RATES.get((guild_id, lane))
+    if lane_rate is None:
+        lane_rate = LANE_RATES[(guild_id, lane)] = DecayingCounter()
+    lane_rate.add(now)
+
+def get_event_rate(guild_id):
+    rate = GUILD_RATES.get(guild_id)
+    return rate.value(time.monotonic()) if rate else 0.0
+
+def get_average_event_rate():
+    if not GUILD_RATES:
+        return 0.0
+    return GLOBAL_RATE.value(time.monotonic()) / len(GUILD_RATES)
+
+def get_lane_rate(guild_id, lane):
+    rate = LANE_RATES.get((guild_id, lane))
+    return rate.value(time.monotonic()) if rate else 0.0
+
+def is_busy_server(guild_id, lane=0):
+    # Each webhook in the server's pool has its own rate limit and every event type is pinned to one of
+    # them, so it is the rate of the lane's own webhook that decides, not the whole server's
+    event_count = get_lane_rate(guild_id, lane)
+    avg_event_count = get_average_event_rate()
     
     # Adjust the threshold based on the average event count
-    if avg_event_count > base_threshold:
+    if avg_event_count > BASE_BUSY_THRESHOLD:
         # If the average event count is higher than the base threshold,
         # lower the threshold for individual servers
-        threshold = max(10, base_threshold - (avg_event_count - base_threshold) // 2)
+        threshold = max(MIN_BUSY_THRESHOLD, BASE_BUSY_THRESHOLD - (avg_event_count - BASE_BUSY_THRESHOLD) // 2)
     else:
-        threshold = base_threshold
+        threshold = BASE_BUSY_THRESHOLD
     
-    logging.debug(f"is_busy_server: Guild ID: {guild_id}, Event Count: {event_count}, Threshold: {threshold}")
+    # Batch more eagerly right after startup, while the backlog of events is catching up
+    threshold = max(MIN_BUSY_THRESHOLD, int(threshold * RAMP_UP_FACTOR))
+    
+    logging.debug(f"is_busy_server: Guild ID: {guild_id}, Event Count: {event_count:.1f}, Threshold: {threshold}")
     return event_count >= threshold
 
-def is_event_enabled(guild_id, event_name):
-    logging.debug(f"is_event_enabled: Guild ID: {guild_id}, Event Name: {event_name}")
-    return event_name in LOG_EVENT_SETTINGS.get(guild_id, set())
+class GuildRoute:
+    # Everything a handler needs to log one server's events, worked out when the configuration changes
+    # instead of on every event
+    __slots__ = ('enabled_mask', 'log_channel', 'webhooks', 'batch_webhook_index', 'audit_log_access')
+
+    def __init__(self):
+        self.enabled_mask = 0  # EVENT_BITS of the events the server logs
+        self.log_channel = None
+        self.webhooks = []  # Pool of RateLimitedWebhooks posting to the log channel
+        self.batch_webhook_index = 0  # Where in the pool the next batched message goes out
+        self.audit_log_access = None  # Whether we can view the audit log, None until checked
+
+    @property
+    def webhook(self):
+        return self.webhooks[0] if self.webhooks else None
+
+    def lane(self, event_name):
+        # Every event of a type goes out on the same webhook, which keeps each type in order
+        return EVENT_LANES.get(event_name, 0) % len(self.webhooks) if self.webhooks else 0
+
+    def webhook_for(self, event_name):
+        return self.webhooks[self.lane(event_name)] if self.webhooks else None
+
+    def batch_webhook(self):
+        # Batched messages are sent one at a time under the batch lock, so they stay in order on any webhook
+        webhook = self.webhooks[self.batch_webhook_index % len(self.webhooks)]
+        self.batch_webhook_index += 1
+        return webhook
+
+    def can_view_audit_log(self):
+        if self.audit_log_access is None:
+            self.audit_log_access = self.log_channel.permissions_for(self.log_channel.guild.me).view_audit_log
+        return self.audit_log_access
+
+def get_guild_route(guild_id):
+    route = GUILD_ROUTES.get(guild_id)
+    if route is None:
+        route = GUILD_ROUTES[guild_id] = GuildRoute()
+    return route
+
+def set_log_events(guild_id, events):
+    get_guild_route(guild_id).enabled_mask = events_to_mask(events)
+
+def set_log_channel(guild_id, log_channel):
+    route = get_guild_route(guild_id)
+    route.log_channel = log_channel
+    route.audit_log_access = None
+
+def set_log_webhooks(guild_id, webhook_urls):
+    route = get_guild_route(guild_id)
+    webhook_urls = webhook_urls or []
+    for webhook in route.webhooks:
+        if webhook.webhook_url not in webhook_urls:
+            # Forget a webhook that was replaced or deleted so its state doesn't linger
+            remove_webhook(webhook.webhook_url)
+            HEAL_FAILURES.pop(guild_id, None)
+    update_request_count_callback = functools.partial(update_request_count, 'webhook', guild_id)
+    route.webhooks = [get_webhook(webhook_url, update_request_count_callback=update_request_count_callback) for webhook_url in webhook_urls]
+
+def forget_guild_route(guild_id):
+    route = GUILD_ROUTES.pop(guild_id, None)
+    HEAL_FAILURES.pop(guild_id, None)
+    if route:
+        for webhook in route.webhooks:
+            remove_webhook(webhook.webhook_url)
+    return route
+
+def set_webhook_healer(healer):
+    # healer(guild_id, webhook) replaces a dead webhook of the server's pool and returns the new RateLimitedWebhook, or None
+    global WEBHOOK_HEALER
+    WEBHOOK_HEALER = healer
+
+async def heal_webhook(guild_id, webhook):
+    # Every event that hits the dead webhook waits on the same attempt instead of starting its own
+    webhook_url = webhook.webhook_url
+    task = HEAL_TASKS.get(webhook_url)
+    if task is None:
+        failed_at = HEAL_FAILURES.get(guild_id)
+        if WEBHOOK_HEALER is None or (failed_at is not None and time.monotonic() - failed_at < HEAL_RETRY_DELAY):
+            return None
+        task = HEAL_TASKS[webhook_url] = asyncio.create_task(WEBHOOK_HEALER(guild_id, webhook))
+        task.add_done_callback(lambda task: HEAL_TASKS.pop(webhook_url, None))
+    try:
+        webhook = await asyncio.shield(task)
+    except Exception as e:
+        logging.error(f"heal_webhook: Guild ID: {guild_id}, Error replacing the webhook: {str(e)}")
+        webhook = None
+    if webhook is None:
+        HEAL_FAILURES[guild_id] = time.monotonic()
+    else:
+        HEAL_FAILURES.pop(guild_id, None)
+    return webhook
+
+async def send_to_webhook(guild_id, webhook, **payload):
+    # A deleted webhook is replaced once and the message sent again, anything else is the caller's to handle
+    try:
+        return await webhook.send(**payload)
+    except WebhookDeadError:
+        logging.warning(f"send_to_webhook: Guild ID: {guild_id}, Log webhook is gone, replacing it")
+        webhook = await heal_webhook(guild_id, webhook)
+        if webhook is None:
+            raise
+        return await webhook.send(**payload)
+
+def invalidate_audit_log_access(guild_id):
+    # Role and channel changes can change our permissions, check again on the next event
+    route = GUILD_ROUTES.get(guild_id)
+    if route is not None:
+        route.audit_log_access = None
+
+def is_logging_any(guild_id, events_mask):
+    route = GUILD_ROUTES.get(guild_id)
+    return route is not None and route.enabled_mask & events_mask != 0
+
+def get_event_route(guild_id, event_name):
+    # Returns the server's route if it logs this event to a channel, None otherwise.
+    # Runs for every gateway event, so it only counts into plain lists
+    bit, index = EVENT_ROUTING[event_name]
+    EVENTS_RECEIVED[index] += 1
+    route = GUILD_ROUTES.get(guild_id)
+    if route is not None and route.enabled_mask & bit and route.log_channel is not None:
+        return route
+    EVENTS_DISABLED[index] += 1
+    return None
+
+def truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+def clamp_embed(embed):
+    # Trim anything that would make Discord reject the whole message the embed is packed into
+    if embed.title and len(embed.title) > MAX_EMBED_TITLE:
+        embed.title = truncate(embed.title, MAX_EMBED_TITLE)
+    if embed.description and len(embed.description) > MAX_EMBED_DESCRIPTION:
+        embed.description = truncate(embed.description, MAX_EMBED_DESCRIPTION)
+    while len(embed.fields) > MAX_EMBED_FIELDS:
+        embed.remove_field(-1)
+    for index, field in enumerate(embed.fields):
+        # Discord rejects empty names and values too, e.g. the content of an attachment-only message
+        name = field.name if field.name and field.name.strip() else EMPTY_FIELD_PLACEHOLDER
+        value = field.value if field.value and field.value.strip() else EMPTY_FIELD_PLACEHOLDER
+        if name is not field.name or value is not field.value or len(name) > MAX_EMBED_FIELD_NAME or len(value) > MAX_EMBED_FIELD_VALUE:
+            embed.set_field_at(index, name=truncate(name, MAX_EMBED_FIELD_NAME), value=truncate(value, MAX_EMBED_FIELD_VALUE), inline=field.inline)
+    while len(embed) > MAX_MESSAGE_EMBED_CHARACTERS and embed.fields:
+        embed.remove_field(-1)
+    return embed
+
+class EventBatch:
+    # Packs embeds into webhook messages as they arrive, so adding an event never walks the whole batch.
+    # Each message is filled greedily and in order, which gives the fewest messages for an in-order split
+    def __init__(self):
+        self.full_payloads = []  # (embeds, events) of messages that can't take another embed
+        self.payload = []  # Message currently being filled
+        self.payload_events = []  # (event name, outbox entry ID, attempts) of the embeds in self.payload
+        self.payload_size = 0  # Characters across the embeds in self.payload
+        self.started_at = 0.0  # When the oldest pending event was batched
+        self.payload_started_at = 0.0
 
-async def log_event(guild_id, event_name, embed):
-    webhook_url = LOG_WEBHOOKS.get(guild_id)
-    if webhook_url:
-        webhook = RateLimitedWebhook(webhook_url, update_request_count_callback=update_request_count)
-        if is_busy_server(guild_id):
+    def __bool__(self):
+        return bool(self.payload or self.full_payloads)
+
+    def append(self, embed, event):
+        now = time.time()
+        if not self:
+            self.started_at = now
+        size = len(embed)  # Measured once, when the embed joins the batch
+        if self.payload and (len(self.payload) >= MAX_EMBEDS_PER_MESSAGE or self.payload_size + size > MAX_MESSAGE_EMBED_CHARACTERS):
+            self.full_payloads.append((self.payload, self.payload_events))
+            self.payload = []
+            self.payload_events = []
+            self.payload_size = 0
+        if not self.payload:
+            self.payload_started_at = now
+        self.payload.append(embed)
+        self.payload_events.append(event)
+        self.payload_size += size
+
+    def take_full_payloads(self):
+        payloads = self.full_payloads
+        self.full_payloads = []
+        self.started_at = self.payload_started_at
+        return payloads
+
+    def take_all_payloads(self):
+        payloads = self.full_payloads
+        if self.payload:
+            payloads.append((self.payload, self.payload_events))
+        self.full_payloads = []
+        self.payload = []
+        self.payload_events = []
+        self.payload_size = 0
+        return payloads
+
+async def deliver(guild_id, webhook, embeds, events):
+    # Sends one message and acknowledges its events. Returns whether it was delivered, events that
+    # failed are queued again later
+    try:
+        await send_to_webhook(guild_id, webhook, embeds=embeds)
+    except WebhookRejectedError as e:
+        # Sending the same message again would be rejected again, so it is dropped from the outbox
+        # instead of being replayed on every start
+        logging.error(f"deliver: Guild ID: {guild_id}, Not delivering {len(events)} events: {str(e)}")
+        for event_name, _, _ in events:
+            increment('events_dropped_total', event=event_name, reason='rejected')
+        acknowledge([entry_id for _, entry_id, _ in events])
+        return False
+    except WebhookError as e:
+        logging.warning(f"deliver: Guild ID: {guild_id}, Retrying {len(events)} events in {RETRY_DELAY} seconds: {str(e)}")
+        defer_events(guild_id, [(event_name, embed, entry_id, attempts) for embed, (event_name, entry_id, attempts) in zip(embeds, events)])
+        return False
+    acknowledge([entry_id for _, entry_id, _ in events])
+    return True
+
+def defer_events(guild_id, events):
+    retry_at = time.monotonic() + RETRY_DELAY
+    for event_name, embed, entry_id, attempts in events:
+        if attempts + 1 >= MAX_SEND_ATTEMPTS:
+            logging.error(f"defer_events: Guild ID: {guild_id}, Event Name: {event_name}, Giving up after {attempts + 1} attempts")
+            increment('events_dropped_total', event=event_name, reason='send_failed')
+            continue
+        DEFERRED_EVENTS.append((retry_at, guild_id, event_name, embed, entry_id, attempts + 1))
+        increment('events_deferred_total', event=event_name)
+
+async def requeue_deferred_events():
+    # Failed events go to the back of their queue once they are due, keeping their outbox entry
+    while True:
+        await asyncio.sleep(1)
+        now = time.monotonic()
+        while DEFERRED_EVENTS and DEFERRED_EVENTS[0][0] <= now:
+            _, guild_id, event_name, embed, entry_id, attempts = DEFERRED_EVENTS.popleft()
+            await queue_event(guild_id, event_name, embed, entry_id=entry_id, attempts=attempts)
+
+async def log_event(guild_id, event_name, embed, entry_id=None, attempts=0):
+    # Returns the number of webhook requests made
+    requests = 0
+    route = GUILD_ROUTES.get(guild_id)
+    webhook = route.webhook_for(event_name) if route else None
+    if webhook:
+        clamp_embed(embed)
+        if is_busy_server(guild_id, route.lane(event_name)):
             logging.debug(f"log_event: Guild ID: {guild_id}, Event Name: {event_name}, Batching event")
             # Batch the events for busy servers
-            if guild_id not in EVENT_BATCHES:
-                EVENT_BATCHES[guild_id] = []
+            batch = EVENT_BATCHES.get(guild_id)
+            if batch is None:
+                batch = EVENT_BATCHES[guild_id] = EventBatch()
             embed.timestamp = datetime.datetime.fromtimestamp(time.time(), datetime.timezone.utc)
-            EVENT_BATCHES[guild_id].append(embed)
+            first_event = not batch
+            batch.append(embed, (event_name, entry_id, attempts))
+            if first_event:
+                schedule_batch_flush(guild_id, batch)
+            increment('events_logged_total', mode='batched')
             
-            # Check if the current batch exceeds the maximum size
-            if sum(len(f"**{e.title}**\n{field.name}: {field.value}\n\n") for e in EVENT_BATCHES[guild_id] for field in e.fields) > MAX_BATCH_SIZE:
+            # Send every message that is already full and keep the last, partially filled one pending
+            if batch.full_payloads:
                 async with BATCH_LOCKS[guild_id]:
-                    batch_message = ""
-                    for batch_embed in EVENT_BATCHES[guild_id]:
-                        batch_message += f"**{batch_embed.title}**\n"
-                        for field in batch_embed.fields:
-                            batch_message += f"{field.name}: {field.value}\n"
-                        batch_message += "\n"
-                    
-                    chunks = [batch_message[i:i+MAX_BATCH_SIZE] for i in range(0, len(batch_message), MAX_BATCH_SIZE)]
-                    for chunk in chunks:
-                        await webhook.send(content=chunk)
-                    
-                    EVENT_BATCHES[guild_id] = []
+                    # If send_batch flushed the batch while we waited for the lock there is nothing left to take
+                    for payload, events in batch.take_full_payloads():
+                        if await deliver(guild_id, route.batch_webhook(), payload, events):
+                            increment('batch_messages_sent_total')
+                        requests += 1
         else:
             logging.debug(f"log_event: Guild ID: {guild_id}, Event Name: {event_name}, Sending individual event")
             # Send individual embeds for light servers
-            await webhook.send(embed=embed)
-        
-        # Update the event counter and timestamp for the server
-        EVENT_COUNTERS[guild_id]['count'] += 1
-        EVENT_COUNTERS[guild_id]['last_event_time'] = time.time()
+            if await deliver(guild_id, webhook, [embed], [(event_name, entry_id, attempts)]):
+                increment('events_logged_total', mode='individual')
+            requests = 1
     else:
         logging.warning(f"log_event: Guild ID: {guild_id}, Event Name: {event_name}, Webhook URL not found")
+        acknowledge([entry_id])  # Nowhere to deliver it, keeping it would only replay it again
+    return requests
+
+async def queue_event(guild_id, event_name, embed, entry_id=None, attempts=0):
+    # Events are written to the outbox first, replayed and retried ones pass the entry ID they already have
+    if entry_id is None:
+        entry_id = await append_to_outbox(guild_id, event_name, embed)
+    # Each webhook in the server's pool gets queues of its own, so they deliver side by side
+    route = GUILD_ROUTES.get(guild_id)
+    lane = route.lane(event_name) if route else 0
+    # Measured on arrival rather than after sending, so a backlog behind the webhook makes the server busy
+    record_event(guild_id, lane)
+    key = (guild_id, LOG_EVENTS.get(event_name, PRIORITY_NORMAL), lane)
+    queue = GUILD_QUEUES.get(key)
+    if queue is None:
+        queue = GUILD_QUEUES[key] = Queue(maxsize=GUILD_QUEUE_SIZE)
+
+    # Wait for room in the queue so a flood slows its own handlers down, but don't wait forever
+    try:
+        await asyncio.wait_for(queue.put((event_name, embed, entry_id, attempts)), timeout=QUEUE_PUT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning(f"queue_event: Guild ID: {guild_id}, Event Name: {event_name}, Queue full, dropping event")
+        increment('events_dropped_total', event=event_name, reason='queue_full')
+        acknowledge([entry_id])
+        return
+
+    if key not in SCHEDULED_GUILDS:
+        SCHEDULED_GUILDS.add(key)
+        schedule_guild(key)
+
+def schedule_guild(key):
+    guild_id, priority, lane = key
+    READY_GUILDS[priority].append((guild_id, lane))
+    READY_COUNT.release()
+
+def higher_priority_ready(priority):
+    return any(READY_GUILDS[higher] for higher in PRIORITY_CLASSES if higher < priority)
+
+async def delivery_worker():
+    while True:
+        await READY_COUNT.acquire()
+        # Always serve the most important class that has anything pending
+        priority = next(priority for priority in PRIORITY_CLASSES if READY_GUILDS[priority])
+        guild_id, lane = READY_GUILDS[priority].popleft()
+        key = (guild_id, priority, lane)
+        queue = GUILD_QUEUES[key]
+
+        # Deficit round robin: every turn adds DELIVERY_QUANTUM requests to the server's allowance and
+        # each event is charged what it cost, so a noisy server can't take more than its share of the webhooks
+        deficit = GUILD_DEFICITS.pop(key, 0) + DELIVERY_QUANTUM
+        try:
+            # Only one worker owns a queue at a time, which keeps the events of each type in order
+            while deficit > 0 and not queue.empty():
+                if higher_priority_ready(priority):
+                    # Step aside, the allowance left over is kept for the next turn
+                    break
+                event_name, embed, entry_id, attempts = queue.get_nowait()
+                try:
+                    requests = await log_event(guild_id, event_name, embed, entry_id, attempts)
+                except Exception as e:
+                    logging.error(f"Error delivering {event_name} for guild {guild_id}: {str(e)}")
+                    requests = 1
+                deficit -= max(requests, BATCHED_EVENT_COST)
+        finally:
+            if queue.empty():
+                SCHEDULED_GUILDS.discard(key)
+            else:
+                GUILD_DEFICITS[key] = max(deficit, 0)
+                schedule_guild(key)
+
+async def replay_events(entries):
+    # Deliver what the last run queued but never sent, in the order it was queued
+    for entry_id, guild_id, event_name, embed in entries:
+        await queue_event(guild_id, event_name, embed, entry_id=entry_id)
+    if entries:
+        logging.info(f"Replayed {len(entries)} undelivered events from the outbox")
+
+def start_delivery_workers():
+    for _ in range(DELIVERY_WORKERS):
+        DELIVERY_TASKS.append(asyncio.create_task(delivery_worker()))
+    DELIVERY_TASKS.append(asyncio.create_task(requeue_deferred_events()))
+
+def get_queue_depths():
+    depths = defaultdict(int)
+    for (guild_id, _, _), queue in GUILD_QUEUES.items():
+        if queue.qsize():
+            depths[guild_id] += queue.qsize()
+    return dict(depths)
 
 async def print_request_counts():
-    global REQUEST_COUNTS
+    latency_snapshots = {endpoint: REQUEST_LATENCIES[endpoint].snapshot() for endpoint in ENDPOINTS}
     while True:
         await asyncio.sleep(60)  # Print every 60 seconds, adjust as needed
-        current_time = time.time()
-        one_minute_ago = current_time - 60
         
         # Count the number of requests in the last minute
-        requests_per_minute = sum(count for timestamp, count in REQUEST_COUNTS.items() if timestamp >= one_minute_ago)
+        requests_per_minute = sum(REQUEST_COUNTS[endpoint].total() for endpoint in ENDPOINTS)
         
-        requests_per_second = requests_per_minute / 60
+        requests_per_second = requests_per_minute / WINDOW_SECONDS
         logging.info(f"Estimated average Discord requests over 1 minute: {requests_per_second:.2f} per second")
-        
-        # Remove old entries from the request counts dictionary
-        REQUEST_COUNTS = defaultdict(int, {timestamp: count for timestamp, count in REQUEST_COUNTS.items() if timestamp >= one_minute_ago})
+
+        for endpoint in ENDPOINTS:
+            histogram = REQUEST_LATENCIES[endpoint]
+            p50 = histogram.percentile(0.5, since=latency_snapshots[endpoint])
+            p99 = histogram.percentile(0.99, since=latency_snapshots[endpoint])
+            latency_snapshots[endpoint] = histogram.snapshot()
+            endpoint_requests = REQUEST_COUNTS[endpoint].total()
+            if p50 is not None:
+                logging.info(f"{endpoint} requests: {endpoint_requests / WINDOW_SECONDS:.2f} per second, latency p50 <= {p50}s, p99 <= {p99}s")
+            elif endpoint_requests:
+                logging.info(f"{endpoint} requests: {endpoint_requests / WINDOW_SECONDS:.2f} per second")
+
+        guild_request_counts = get_guild_request_counts()
+        if guild_request_counts:
+            busiest = sorted(guild_request_counts.items(), key=lambda item: item[1], reverse=True)[:5]
+            busiest_formatted = ', '.join(f"{guild_id}: {count}" for guild_id, count in busiest)
+            logging.info(f"Servers with the most requests over 1 minute: {busiest_formatted}")
+
+        queue_depths = get_queue_depths()
+        if queue_depths:
+            busiest = sorted(queue_depths.items(), key=lambda item: item[1], reverse=True)[:5]
+            busiest_formatted = ', '.join(f"{guild_id}: {depth}" for guild_id, depth in busiest)
+            logging.info(f"Pending events: {sum(queue_depths.values())} across {len(queue_depths)} servers (busiest: {busiest_formatted})")
 
 def get_batch_interval(guild_id):
-    event_count = EVENT_COUNTERS[guild_id]['count']
+    event_count = get_event_rate(guild_id)
     base_interval = 10  # Base interval in seconds
     
     multiplier = 1 + (event_count // 10) * 0.5
-    return base_interval * multiplier
+    # The flush deadline is checked again as the rate decays, so without a cap the last batch of a
+    # burst kept being pushed back for minutes
+    return min(base_interval * multiplier, MAX_BATCH_INTERVAL)
         
 async def ramp_up_logging():
+    global RAMP_UP_FACTOR
     start_time = time.time()
     while True:
         elapsed_time = time.time() - start_time
         ramp_up_factor = min(elapsed_time / RAMP_UP_DURATION, 1.0)
         
-        # Adjust the event counter threshold based on the ramp-up factor
-        for guild_id in EVENT_COUNTERS:
-            event_count = EVENT_COUNTERS[guild_id]['count']
-            threshold = min(10 + event_count // 10, 50)
-            EVENT_COUNTERS[guild_id]['threshold'] = int(threshold * ramp_up_factor)
+        # is_busy_server scales its threshold by this factor
+        RAMP_UP_FACTOR = ramp_up_factor
         
         if ramp_up_factor >= 1.0:
             break
         
         await asyncio.sleep(1)  # Check every second
 
-async def send_pending_batches():
-    while True:
-        try:
-            current_time = datetime.datetime.now(datetime.timezone.utc)
-            tasks = []
-            for guild_id, batch in EVENT_BATCHES.items():
-                if batch:
-                    if batch[0].timestamp is not None:
-                        batch_interval = get_batch_interval(guild_id)
-                        if (current_time - batch[0].timestamp).total_seconds() >= batch_interval:
-                            tasks.append(send_batch(guild_id, batch))
-                    else:
-                        # Remove the batch if the timestamp is None
-                        EVENT_BATCHES[guild_id] = []
-            
-            if tasks:
-                await asyncio.gather(*tasks)
-        except Exception as e:
-            logging.error(f"Error in send_pending_batches: {str(e)}")
+def start_ramp_up():
+    RAMP_UP_TASKS.append(asyncio.create_task(ramp_up_logging()))
 
-        await asyncio.sleep(1)  # Check every second
+def schedule_batch_flush(guild_id, batch):
+    # Each batch sets a timer for when it is due, so nothing runs for batches that aren't
+    delay = batch.started_at + get_batch_interval(guild_id) - time.time()
+    asyncio.get_running_loop().call_later(max(delay, 0), flush_due_batch, guild_id, batch)
+
+def flush_due_batch(guild_id, batch):
+    if EVENT_BATCHES.get(guild_id) is not batch or not batch:
+        return  # Already sent by an earlier timer
+    if batch.started_at + get_batch_interval(guild_id) > time.time():
+        # The full messages went out in the meantime, wait until the one still filling up is due
+        schedule_batch_flush(guild_id, batch)
+        return
+    task = asyncio.create_task(flush_batch(guild_id))
+    FLUSH_TASKS.add(task)
+    task.add_done_callback(FLUSH_TASKS.discard)
 
-async def send_batch(guild_id, batch):
+async def flush_batch(guild_id):
+    try:
+        await send_batch(guild_id)
+    except Exception as e:
+        logging.error(f"Error sending the batch for guild {guild_id}: {str(e)}")
+
+async def send_batch(guild_id):
     async with BATCH_LOCKS[guild_id]:
-        batch_message = ""
-        for batch_embed in batch:
-            batch_message += f"**{batch_embed.title}**\n"
-            for field in batch_embed.fields:
-                batch_message += f"{field.name}: {field.value}\n"
-            batch_message += "\n"
-        
-        webhook_url = LOG_WEBHOOKS.get(guild_id)
-        if webhook_url:
-            webhook = RateLimitedWebhook(webhook_url, update_request_count_callback=update_request_count)
-            chunks = [batch_message[i:i+MAX_BATCH_SIZE] for i in range(0, len(batch_message), MAX_BATCH_SIZE)]
-            for chunk in chunks:
-                await webhook.send(content=chunk)
+        # Take the batch before sending, events batched while we wait on the webhook start a new one
+        batch = EVENT_BATCHES.pop(guild_id, None)
         
-        EVENT_BATCHES[guild_id] = []
+        route = GUILD_ROUTES.get(guild_id)
+        if route and route.webhooks and batch:
+            for payload, events in batch.take_all_payloads():
+                if await deliver(guild_id, route.batch_webhook(), payload, events):
+                    increment('batch_messages_sent_total')
 
-def update_request_count():
-    current_time = time.time()
-    REQUEST_COUNTS[current_time] = REQUEST_COUNTS.get(current_time, 0) + 1
+def update_request_count(endpoint='rest', guild_id=None, latency=None):
+    record_request(endpoint, guild_id=guild_id, latency=latency)